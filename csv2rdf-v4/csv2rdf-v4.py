@@ -6,7 +6,8 @@
 #============================================
 #!/usr/bin/env python3
 
-import getopt, sys, csv, configparser, os.path, traceback, time, os
+import getopt, sys, csv, configparser, os.path, traceback, time, os, cProfile, pstats
+import threading
 from os.path import exists
 
 #Conditional import
@@ -26,6 +27,10 @@ SOUND = 'mixkit-achievement-bell-600.wav'
 
 VERBOSE = False
 INTERRUPT = False
+PROFILE = None # None, FULL or LIGHT
+PROFILE_DIR = "profile"
+FULL = "full"   # cProfile per phase and sampled stacks
+LIGHT = "light" # sampled stacks only, cheap enough for production runs
 
 
 #============================================ interrupt
@@ -178,6 +183,105 @@ class RDFStoreChunks():
         print("Stores dumped")
 
 
+#================================================= Sampler
+class Sampler():
+    '''
+    Thread sampling the stack of the main thread every INTERVAL seconds
+    during the phases run by profiled(). The samples are written as
+    collapsed stacks ('phase;frame;frame N') into PROFILE_DIR/profile.collapsed
+    for flamegraph.pl or speedscope.
+    '''
+    INTERVAL = 0.01
+    def __init__(self):
+        self.phase = None
+        # self.stacks = { collapsed stack: number of samples }
+        self.stacks = {}
+        self.target = threading.main_thread().ident
+        self.running = True
+        self.thread = threading.Thread(target=self.sample, daemon=True)
+        self.thread.start()
+    def sample(self):
+        while self.running:
+            time.sleep(self.INTERVAL)
+            phase = self.phase
+            if phase is None:
+                continue
+            frame = sys._current_frames().get(self.target)
+            frames = []
+            while frame is not None:
+                code = frame.f_code
+                frames.append(os.path.basename(code.co_filename) + ":" + code.co_name)
+                frame = frame.f_back
+            stack = phase + ";" + ";".join(reversed(frames))
+            self.stacks[stack] = self.stacks.get(stack, 0) + 1
+    def top(self, phase, nb=10):
+        '''
+        Returns [(function, seconds)] of the nb functions of the phase
+        with the most samples as innermost frame
+        '''
+        selftime = {}
+        for stack, count in self.stacks.items():
+            if stack.startswith(phase + ";"):
+                leaf = stack.rsplit(";", 1)[1]
+                selftime[leaf] = selftime.get(leaf, 0) + count * self.INTERVAL
+        return sorted(selftime.items(), key=lambda x: x[1], reverse=True)[:nb]
+    def write(self):
+        self.running = False
+        self.thread.join()
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        collapsed = os.path.join(PROFILE_DIR, "profile.collapsed")
+        with open(collapsed, "w", encoding='utf-8', newline='\n') as f:
+            for stack, count in self.stacks.items():
+                f.write(stack + " " + str(count) + "\n")
+        print("Sampled stacks written into " + collapsed)
+
+SAMPLER = None
+
+
+#================================================= profiled
+def profiled(name, function, *args):
+    '''
+    Runs function(*args) as the phase name of the run. With '--profile',
+    the phase is profiled with cProfile: PROFILE_DIR/[name].pstats is
+    written and the top functions are printed. With '--profile' and
+    '--profile-light', the stacks of the phase are sampled (see Sampler).
+    '''
+    global SAMPLER
+    if PROFILE is None:
+        return function(*args)
+    if SAMPLER is None:
+        SAMPLER = Sampler()
+    SAMPLER.phase = name
+    start = time.time()
+    try:
+        if PROFILE == LIGHT:
+            result = function(*args)
+        else:
+            profile = cProfile.Profile()
+            result = profile.runcall(function, *args)
+    finally:
+        SAMPLER.phase = None
+    print("------\nProfile of phase '" + name + "': " + "%.3f" % (time.time() - start) + " s")
+    if PROFILE == LIGHT:
+        for function, seconds in SAMPLER.top(name):
+            print("  %8.3f s  %s" % (seconds, function))
+        return result
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    stats = pstats.Stats(profile)
+    stats.dump_stats(os.path.join(PROFILE_DIR, name + ".pstats"))
+    stats.sort_stats('tottime').print_stats(10)
+    return result
+
+
+#================================================= count_lines
+def count_lines(file, delim):
+    newreader = csv.reader(open(file, "r", encoding='utf-8', errors='ignore'), delimiter=delim)
+    nblines = 0
+    for i, row in enumerate(newreader):
+        nblines += 1
+    return nblines
+
+
 #================================================= RDFStore
 class RDFStore():
     '''
@@ -332,7 +436,7 @@ class Column():
                        RDF.type,
                        URIRef(domain + format_predicate(mytype))))
             #date_stamp(store, domain, URIRef(domain + format_predicate(cell)))
-            generate_type_triples(self.mydict['celltypes'].split(','), store, domain, True)
+            # type hierarchy is generated once by generate_schema
             # there are neither 'columns' nor column types
             return
 
@@ -419,14 +523,10 @@ class Column():
             store.add((rdfcell,    rdfcoltype,  rdfpkey))
             store.add((rdfcoltype, RDFS.domain, rdfcelltype))
             store.add((rdfcoltype, RDFS.range,  rdfpkeytype))
-            generate_type_triples(celltypes, store, domain, True)
-            generate_type_triples(coltypes,  store, domain, False)
         elif cellgrammar[0] == 'object':
             store.add((rdfpkey,    rdfcoltype,  rdfcell))
             store.add((rdfcoltype, RDFS.domain, rdfpkeytype))
             store.add((rdfcoltype, RDFS.range,  rdfcelltype))
-            generate_type_triples(celltypes, store, domain, True)
-            generate_type_triples(coltypes,  store, domain, False)
         else:
             # Maybe we'll need this case to be implemented one day but I have doubts about it
             if cellgrammar[0] == 'predicate':
@@ -435,6 +535,18 @@ class Column():
         #date_stamp(store, domain, rdfcell)           
         if VERBOSE: print("Done for cell: " + cell)
 
+    #------------------------------------------generate_schema
+    def generate_schema(self,store,domain):
+        '''
+        The class and property hierarchies only depend on the grammar
+        so they are generated once and not for every cell
+        '''
+        if self.to_ignore or self.is_pkey_descr:
+            return
+        generate_type_triples(self.mydict['celltypes'].split(','), store, domain, True)
+        if not self.is_pkey:
+            generate_type_triples(self.mydict['columntypes'].split(','), store, domain, False)
+
 
 #================================================= Grammar
 class Grammar():
@@ -509,8 +621,16 @@ class Grammar():
                     sections.append(self.columns[k])
         return sections
 
+    #----------------------------------------------------generate_schema
+    def generate_schema(self, source, store):
+        '''
+        Schema triples are generated once per grammar, before the rows
+        '''
+        for k in self.columns:
+            self.columns[k].generate_schema(store, source.domain)
+
     #----------------------------------------------------semantic_parser
-    def semantic_parser(self, source, store):
+    def semantic_parser(self, source, store, nblines = None):
         delim = source.delim
         try:
             # CSV files may contain non UTF8 chars
@@ -526,10 +646,8 @@ class Grammar():
             tim = Timer()
             pkeyindex = -1
             #counting the lines with a specific reader
-            newreader = csv.reader(open(source.file, "r", encoding='utf-8', errors='ignore'), delimiter=delim)
-            nblines = 0
-            for i, row in enumerate(newreader):
-                nblines += 1
+            if nblines is None:
+                nblines = count_lines(source.file, delim)
             print("------\nSource: " + source .name + "\nNumber of lines to process: " + str(nblines))
             bar = progressbar2.ProgressBar(max_value=nblines)
             # main loop
@@ -602,6 +720,9 @@ def usage():
     print("Usage: \n $ csv2rdf -c [CONFIG] -i")
     print("CONFIG must be an '.ini' file")
     print("'-i' starts the step by step processing")
+    print("'--profile' profiles each phase with cProfile into profile/*.pstats")
+    print("    and the sampled stacks into profile/profile.collapsed (flamegraph)")
+    print("'--profile-light' only samples the stacks (low overhead)")
     sys.exit(0)
 
 
@@ -625,7 +746,8 @@ def main():
     try:
         # Option 't' is a hidden option
         opts, args = getopt.getopt(sys.argv[1:], "c:ih",
-                                   ["conf=", "interactive", "help"])
+                                   ["conf=", "interactive", "help", "profile",
+                                    "profile-light"])
     except getopt.GetoptError:
         # print help information and exit:
         usage()
@@ -643,6 +765,11 @@ def main():
             VERBOSE = True
             global INTERRUPT
             INTERRUPT = True
+        if o == "--profile":
+            global PROFILE
+            PROFILE = FULL
+        if o == "--profile-light":
+            PROFILE = LIGHT
         if o in ("-c", "--conf"):
             options = a
             print("Configuration file: " + a)
@@ -651,7 +778,7 @@ def main():
     if options == None:
         usage()
         sys.exit()
-    opt = Options(options)
+    opt = profiled("options", Options, options)
     opt.print()
 
     start_time = time.time()
@@ -673,11 +800,15 @@ def main():
             default_csv_parser(source, store)
         else:
             # Parsing the grammar file
-            gram = Grammar(source.semanticfile)
-            gram.semantic_parser(source, store)
+            gram = profiled(source.name + ".grammar", Grammar, source.semanticfile)
+            gram.generate_schema(source, store)
+            nblines = profiled(source.name + ".count", count_lines, source.file, source.delim)
+            profiled(source.name + ".rows", gram.semantic_parser, source, store, nblines)
 
         # Dumping the triplestore
-        store.dump()
+        profiled(source.name + ".dump", store.dump)
+    if SAMPLER is not None:
+        SAMPLER.write()
     #interrupt("DEBUG")
     dir = os.path.dirname(os.path.realpath(__file__))
     music = os.path.join(dir, SOUND)
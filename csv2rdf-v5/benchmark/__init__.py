@@ -0,0 +1,12 @@
+#============================================
+# File name:      benchmark/__init__.py
+# Author:         Olivier Rey
+# Date:           September 2024
+# License:        GPL v3
+#============================================
+'''
+Benchmark suite of csv2rdf, to be run from the csv2rdf-v5 folder:
+  $ python -m benchmark.generate -g mipl-grammar-em.ini -n 100000 -o em.csv
+  $ python -m benchmark.run -g mipl-grammar-em.ini --rows 10000,100000
+  $ python -m benchmark.micro -g mipl-grammar-em.ini
+'''
@@ -0,0 +1,226 @@
+#============================================
+# File name:      benchmark/generate.py
+# Author:         Olivier Rey
+# Date:           September 2024
+# License:        GPL v3
+#============================================
+#!/usr/bin/env python3
+
+import getopt, sys, csv, configparser, os.path, random
+from datetime import date, timedelta
+
+#--- grammar keys and values (see csv2rdf-v5.py)
+MULTITREATMENT = '$'
+CELLROLE = 'cellrole'
+CELLTYPE = 'celltype'
+IGNORE = 'ignore'
+PKEY = 'pkey'
+LITERALS = ["string", "integer", "float", "date"]
+
+#--- default generation parameters
+DEFAULT_CARD = 1000 # distinct values per column
+PKEY_RATIO = 3      # the pkey takes rows/PKEY_RATIO distinct values
+EMPTY_RATE = 0.05   # rate of empty cells (never for the pkey)
+MISS_RATE = 0.01    # rate of values not in the map lists
+FIRST_DATE = date(2000, 1, 1)
+
+
+#============================================ CSVColumn
+class CSVColumn():
+    '''
+    One column of the generated CSV file and the grammar sections
+    reading it (several sections for 'NAME$1', 'NAME$2', ...)
+    self.treatments = [ (cellrole, celltype), ... ]
+    '''
+    def __init__(self, name):
+        self.name = name
+        self.treatments = []
+        self.card = DEFAULT_CARD
+        self.ispkey = False
+        self.ignored = True
+        # map(all;*list*): keys of the list
+        self.keys = None
+        # map(prefix;*list*): keys of the list, followed by digits
+        self.prefixes = None
+        # map(inf:max;*list*): [ (inf, max, keys), ... ]
+        self.parts = []
+        self.literal = None
+    def add(self, cellrole, celltype, lists):
+        self.treatments.append((cellrole, celltype))
+        if cellrole == IGNORE:
+            return
+        self.ignored = False
+        if cellrole == PKEY:
+            self.ispkey = True
+            return
+        if celltype in LITERALS:
+            self.literal = celltype
+            return
+        # 'split(...)' may come before or after the map command
+        commands = [command for command in cellrole.split(',')[1:]
+                    if command.startswith("map(")]
+        if len(commands) == 0:
+            return
+        args = commands[0][4:-1].split(';')
+        keys = [key.upper() for key in lists.get(args[1], {})]
+        if args[0] == 'all':
+            self.keys = keys
+        elif args[0] == 'prefix':
+            self.prefixes = keys
+        else:
+            [myinf, mymax] = args[0].split(':')
+            myinf = int(myinf) if myinf != "" else 0
+            mymax = int(mymax) if mymax != "" else myinf + 1
+            keys = [key for key in keys if len(key) == mymax - myinf]
+            self.parts.append((myinf, mymax, keys))
+
+    #--- one cell value
+    def value(self, rand, missrate, emptyrate):
+        if self.ignored:
+            return "x"
+        if not self.ispkey and rand.random() < emptyrate:
+            return ""
+        k = rand.randrange(self.card)
+        if self.ispkey:
+            return "PN-%06d" % k
+        if self.keys is not None:
+            if rand.random() < missrate or len(self.keys) == 0:
+                return "ZZ%d" % k
+            return rand.choice(self.keys)
+        if self.prefixes is not None:
+            if rand.random() < missrate or len(self.prefixes) == 0:
+                return "ZZ%d" % k
+            return rand.choice(self.prefixes) + "%d" % k
+        if self.parts:
+            width = max(mymax for (myinf, mymax, keys) in self.parts)
+            cell = list(("%0" + str(width) + "d") % k)[:width]
+            for (myinf, mymax, keys) in self.parts:
+                if rand.random() < missrate or len(keys) == 0:
+                    key = "#" * (mymax - myinf)
+                else:
+                    key = rand.choice(keys)
+                cell[myinf:mymax] = list(key)
+            return "".join(cell)
+        if self.literal == "integer":
+            return str(k)
+        if self.literal == "float":
+            return "%d.%02d" % (k, k % 100)
+        if self.literal == "date":
+            return str(FIRST_DATE + timedelta(days=k))
+        if self.literal == "string":
+            return "Part %d, \"grade\" %d" % (k, k % 7)
+        return "%s-%d" % (self.name[:3].upper(), k)
+
+
+#============================================ read_grammar
+def read_grammar(filename):
+    '''
+    Returns the CSV columns described by a v5 grammar file, in order
+    '''
+    if not os.path.isfile(filename):
+        raise FileNotFoundError('File "' + filename + '" not found.')
+    config = configparser.ConfigParser()
+    config.read(filename)
+    lists = {}
+    for elem in config.sections():
+        if elem.startswith('*') and elem.endswith('*'):
+            lists[elem] = dict(config[elem])
+    columns = {}
+    for elem in config.sections():
+        if elem.startswith('*'):
+            continue
+        name = elem
+        if len(elem) > 1 and elem[-2] == MULTITREATMENT:
+            name = elem.split(MULTITREATMENT)[0]
+        if name not in columns:
+            columns[name] = CSVColumn(name)
+        columns[name].add(config[elem].get(CELLROLE, IGNORE),
+                          config[elem].get(CELLTYPE, ""),
+                          lists)
+    return list(columns.values())
+
+
+#============================================ generate
+def generate(grammar, rows, output, delim=';', cards=None,
+             missrate=MISS_RATE, emptyrate=EMPTY_RATE, seed=1):
+    '''
+    Writes a CSV file of rows rows matching the grammar.
+    cards = { column name: number of distinct values }
+    Returns the list of the CSV columns.
+    '''
+    rand = random.Random(seed)
+    columns = read_grammar(grammar)
+    for column in columns:
+        if column.ispkey:
+            column.card = max(1, rows // PKEY_RATIO)
+        if cards is not None and column.name in cards:
+            column.card = max(1, cards[column.name])
+    with open(output, 'w', encoding='utf-8', newline='') as f:
+        writer = csv.writer(f, delimiter=delim, lineterminator='\n')
+        writer.writerow([column.name for column in columns])
+        for i in range(rows):
+            writer.writerow([column.value(rand, missrate, emptyrate)
+                             for column in columns])
+    return columns
+
+
+#============================================ usage
+def usage():
+    print("Generates a synthetic CSV file from a csv2rdf-v5 grammar")
+    print("Usage: \n $ python -m benchmark.generate -g [GRAMMAR] -n [ROWS] -o [CSV]")
+    print("'--card NAME=N' sets the number of distinct values of a column (repeatable)")
+    print("'--miss R' sets the rate of values missing in the map lists (default "
+          + str(MISS_RATE) + ")")
+    print("'--empty R' sets the rate of empty cells (default " + str(EMPTY_RATE) + ")")
+    print("'--seed N' sets the random seed (default 1)")
+    sys.exit(0)
+
+
+def parse_cards(values):
+    cards = {}
+    for value in values:
+        name, _, card = value.rpartition('=')
+        cards[name] = int(card)
+    return cards
+
+
+#================================================= main
+def main():
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "g:n:o:h",
+                                   ["grammar=", "rows=", "output=", "card=",
+                                    "miss=", "empty=", "seed=", "help"])
+    except getopt.GetoptError:
+        usage()
+    grammar = None
+    rows = 10000
+    output = "synthetic.csv"
+    cards = []
+    missrate = MISS_RATE
+    emptyrate = EMPTY_RATE
+    seed = 1
+    for o, a in opts:
+        if o in ("-h", "--help"):
+            usage()
+        if o in ("-g", "--grammar"):
+            grammar = a
+        if o in ("-n", "--rows"):
+            rows = int(a)
+        if o in ("-o", "--output"):
+            output = a
+        if o == "--card":
+            cards.append(a)
+        if o == "--miss":
+            missrate = float(a)
+        if o == "--empty":
+            emptyrate = float(a)
+        if o == "--seed":
+            seed = int(a)
+    if grammar is None:
+        usage()
+    generate(grammar, rows, output, ';', parse_cards(cards), missrate, emptyrate, seed)
+    print(str(rows) + " rows written into " + output)
+
+
+if __name__ == '__main__':
+    main()
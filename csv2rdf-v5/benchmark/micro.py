@@ -0,0 +1,132 @@
+#============================================
+# File name:      benchmark/micro.py
+# Author:         Olivier Rey
+# Date:           September 2024
+# License:        GPL v3
+#============================================
+#!/usr/bin/env python3
+
+import getopt, sys, os, os.path, json, timeit, random, importlib.util
+
+from benchmark.generate import read_grammar
+
+HERE = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+NUMBER = 100000 # calls per measure
+REPEAT = 5      # the best of REPEAT measures is kept
+
+
+#============================================ load_v5
+def load_v5():
+    '''
+    csv2rdf-v5.py cannot be imported by name (dash in the file name)
+    '''
+    sys.path.insert(0, HERE)
+    spec = importlib.util.spec_from_file_location("csv2rdf_v5",
+                                                  os.path.join(HERE, "csv2rdf-v5.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+#============================================ NullStore
+class NullStore():
+    '''
+    Store discarding the triples: only the cost of building them is measured
+    '''
+    def add(self, triple):
+        pass
+
+
+#============================================ measures
+def measure(name, function, values, number=NUMBER):
+    '''
+    Calls function on the values, in a loop, number times in total.
+    Returns the best time per call in nanoseconds.
+    '''
+    loops = max(1, number // len(values))
+    def run():
+        for value in values:
+            function(value)
+    best = min(timeit.repeat(run, number=loops, repeat=REPEAT))
+    ns = best * 1e9 / (loops * len(values))
+    print("  %-50s %10.0f ns/call" % (name, ns))
+    return {"name": name, "ns_per_call": round(ns, 1)}
+
+def micro_benchmarks(grammar, number=NUMBER, seed=1):
+    v5 = load_v5()
+    v5.set_console(None)
+    v5.init_log(os.devnull)
+    rand = random.Random(seed)
+    # sample rows of the grammar
+    columns = read_grammar(grammar)
+    header = [column.name for column in columns]
+    rows = [[column.value(rand, 0.01, 0.05) for column in columns] for i in range(1000)]
+    gram = v5.Grammar(grammar, "https://www.nhindustries.com/rdf/mipl/", ';',
+                      v5.OntologyRegistry())
+    gram.bind_header(header)
+    results = []
+    print("format_URI")
+    cells = [row[i] for row in rows for i in range(len(header))]
+    results.append(measure("format_URI", v5.format_URI, cells, number))
+    print("URIMinter.uri (cached and not cached)")
+    results.append(measure("URIMinter.uri",
+                           lambda v: gram.minter.uri(gram.domain, v), cells, number))
+    results.append(measure("URIMinter.mint_uri",
+                           lambda v: gram.minter.mint_uri(gram.domain, v), cells, number))
+    print("alter_cell_value")
+    for name, colobj in gram.columns.items():
+        if isinstance(colobj, v5.URIColumn) and colobj.altermode != v5.NONE:
+            values = [row[colobj.index] for row in rows]
+            results.append(measure("alter_cell_value " + name,
+                                   colobj.alter_cell_value, values, number))
+    print("column plans (the pkey URI included)")
+    store = NullStore()
+    for name, colobj in gram.columns.items():
+        values = [row for row in rows if row[colobj.index].strip() != ""]
+        if len(values) == 0:
+            continue
+        plan = gram.compile_plan([name])
+        results.append(measure("plan " + name,
+                               lambda row: plan(row, store.add), values, number))
+    print("convert_row (compiled plan)")
+    results.append(measure("convert_row", lambda row: gram.convert_row(row, store),
+                           rows, number // 10))
+    return results
+
+
+#============================================ usage
+def usage():
+    print("Micro-benchmarks of the hot paths of csv2rdf-v5")
+    print("Usage: \n $ python -m benchmark.micro [-g GRAMMAR] [-n CALLS] [--output FILE]")
+    sys.exit(0)
+
+
+#================================================= main
+def main():
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "g:n:h",
+                                   ["grammar=", "number=", "output=", "help"])
+    except getopt.GetoptError:
+        usage()
+    grammar = os.path.join(HERE, "mipl-grammar-em.ini")
+    number = NUMBER
+    output = None
+    for o, a in opts:
+        if o in ("-h", "--help"):
+            usage()
+        if o in ("-g", "--grammar"):
+            grammar = a
+        if o in ("-n", "--number"):
+            number = int(a)
+        if o == "--output":
+            output = a
+    results = micro_benchmarks(grammar, number)
+    if output is not None:
+        with open(output, 'w', encoding='utf-8') as f:
+            json.dump({"grammar": os.path.abspath(grammar), "results": results},
+                      f, indent=2)
+        print("Results written into " + output)
+
+
+if __name__ == '__main__':
+    main()
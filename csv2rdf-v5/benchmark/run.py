@@ -0,0 +1,244 @@
+#============================================
+# File name:      benchmark/run.py
+# Author:         Olivier Rey
+# Date:           September 2024
+# License:        GPL v3
+#============================================
+#!/usr/bin/env python3
+
+import getopt, sys, os, os.path, json, time, subprocess, sqlite3, platform
+from datetime import datetime
+
+from benchmark.generate import generate, parse_cards, MISS_RATE, EMPTY_RATE
+
+HERE = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ROOT = os.path.dirname(HERE)
+V1DIR = os.path.join(ROOT, "csv2rdf")
+V4 = os.path.join(ROOT, "csv2rdf-v4", "csv2rdf-v4.py")
+V4GRAMMAR = os.path.join(ROOT, "csv2rdf-v4", "mipl-grammar.ini")
+V5 = os.path.join(HERE, "csv2rdf-v5.py")
+
+SOURCE = "BENCH"
+DOMAIN = "https://www.nhindustries.com/rdf/mipl/"
+DEFAULT_ROWS = [10000, 100000]
+RESULTS = "benchmark-results.json"
+
+#--- engine modes: name -> (engine, extra v5 options, v5 backend, output extension)
+MODES = {
+    "v1":          ("v1", [], None, ".ttl"),
+    "v4":          ("v4", [], None, ".ttl"),
+    "v5-memory":   ("v5", [], "memory", ".ttl"),
+    "v5-stream":   ("v5", ["--stream"], "memory", ".nt"),
+    "v5-sqlite":   ("v5", [], "sqlite", ".sqlite"),
+    "v5-split":    ("v5", ["--split", "2", "--concat"], "memory", ".nt"),
+    "v5-columnar": ("v5", ["--engine", "columnar"], "memory", ".nt"),
+}
+DEFAULT_MODES = ["v1", "v4", "v5-memory", "v5-stream", "v5-sqlite", "v5-columnar"]
+
+# v1 has no command line working on a CSV file: its default parser is driven here
+V1_DRIVER = '''import sys
+sys.path.insert(0, sys.argv[1])
+from csv2rdf import Options, RDFStore, default_csv_parser
+store = RDFStore(sys.argv[4])
+default_csv_parser(Options(sys.argv[2]), sys.argv[3], store)
+store.dump()
+'''
+
+COUNT_TURTLE = '''import sys
+from rdflib import Graph
+print(len(Graph().parse(sys.argv[1], format="turtle")))
+'''
+
+
+#============================================ configuration files
+def write_conf(mode, folder, csvfile, grammar):
+    '''
+    Writes the configuration file of the engine into folder
+    and returns the command line
+    '''
+    (engine, extra, backend, ext) = MODES[mode]
+    conf = os.path.join(folder, "conf.ini")
+    with open(conf, 'w', encoding='utf-8') as f:
+        if engine == "v1":
+            f.write("[" + csvfile + "]\n")
+        else:
+            f.write("[" + SOURCE + "]\n")
+            f.write("file = " + csvfile + "\n")
+        f.write("domain = " + DOMAIN + "\n")
+        f.write("delimiter = ;\n")
+        if engine == "v1":
+            f.write("type = Part\npredicate_prefix = Part_\n")
+        elif engine == "v4":
+            f.write("type = Part\npredicate_prefix = Part_\n")
+            f.write("semantics = " + V4GRAMMAR + "\nactive = True\n")
+        else:
+            f.write("semantics = " + grammar + "\nactive = True\n")
+            f.write("backend = " + backend + "\n")
+    if engine == "v1":
+        return [sys.executable, "-c", V1_DRIVER, V1DIR, conf, csvfile, SOURCE]
+    if engine == "v4":
+        return [sys.executable, V4, "-c", conf]
+    return [sys.executable, V5, "-c", conf] + extra
+
+
+#============================================ measures
+def count_triples(output):
+    '''
+    Number of triples of an output file, None if not available.
+    N-Triples outputs are not deduplicated: their lines are counted.
+    '''
+    if not os.path.isfile(output):
+        return None
+    if output.endswith(".nt"):
+        with open(output, 'rb') as f:
+            return sum(1 for line in f if line.strip() != b"")
+    if output.endswith(".sqlite"):
+        db = sqlite3.connect(output)
+        nb = db.execute("SELECT COUNT(*) FROM triples").fetchone()[0]
+        db.close()
+        return nb
+    # parsed in another process: Linux keeps the peak RSS of the parent
+    # process in the peak RSS of the next children (fork then exec)
+    nb = subprocess.run([sys.executable, "-c", COUNT_TURTLE, output],
+                        capture_output=True, text=True)
+    return int(nb.stdout) if nb.returncode == 0 else None
+
+def run_mode(mode, rows, csvfile, grammar, workdir, count=True):
+    '''
+    Runs one engine mode in its own folder and returns its measures.
+    The peak RSS is the one of the child process (os.wait4).
+    '''
+    folder = os.path.abspath(os.path.join(workdir, str(rows), mode))
+    os.makedirs(folder, exist_ok=True)
+    command = write_conf(mode, folder, csvfile, grammar)
+    output = os.path.join(folder, SOURCE + MODES[mode][3])
+    if os.path.isfile(output):
+        os.remove(output)
+    with open(os.path.join(folder, "console.txt"), 'w') as console:
+        start = time.perf_counter()
+        proc = subprocess.Popen(command, cwd=folder, stdout=console,
+                                stderr=subprocess.STDOUT)
+        (pid, status, usage) = os.wait4(proc.pid, 0)
+        seconds = time.perf_counter() - start
+        proc.returncode = os.waitstatus_to_exitcode(status)
+    triples = count_triples(output) if count else None
+    result = {
+        "mode": mode,
+        "engine": MODES[mode][0],
+        "rows": rows,
+        "returncode": proc.returncode,
+        "seconds": round(seconds, 3),
+        "rows_per_s": round(rows / seconds, 1),
+        "triples": triples,
+        "triples_per_s": round(triples / seconds, 1) if triples else None,
+        # ru_maxrss is in kilobytes on Linux
+        "peak_rss_kb": usage.ru_maxrss,
+        "output_bytes": os.path.getsize(output) if os.path.isfile(output) else None,
+    }
+    return result
+
+
+#============================================ benchmark
+def benchmark(grammar, sizes, modes, workdir, cards=None, missrate=MISS_RATE,
+              emptyrate=EMPTY_RATE, count=True):
+    '''
+    Generates one CSV file per size and runs all the modes on it
+    '''
+    os.makedirs(workdir, exist_ok=True)
+    results = []
+    for rows in sizes:
+        csvfile = os.path.abspath(os.path.join(workdir, "bench-" + str(rows) + ".csv"))
+        if not os.path.isfile(csvfile):
+            print("Generating " + csvfile)
+            generate(grammar, rows, csvfile, ';', cards, missrate, emptyrate)
+        for mode in modes:
+            print("Running " + mode + " on " + str(rows) + " rows", flush=True)
+            result = run_mode(mode, rows, csvfile, os.path.abspath(grammar),
+                              workdir, count)
+            print_result(result)
+            results.append(result)
+    return results
+
+def print_result(r):
+    if r["returncode"] != 0:
+        print("  %-12s failed (exit code %d), see console.txt"
+              % (r["mode"], r["returncode"]))
+        return
+    print("  %-12s %8.2f s %10.0f rows/s %12s triples/s %8d MB RSS"
+          % (r["mode"], r["seconds"], r["rows_per_s"],
+             "-" if r["triples_per_s"] is None else "%.0f" % r["triples_per_s"],
+             r["peak_rss_kb"] // 1024))
+
+
+#============================================ usage
+def usage():
+    print("Runs the csv2rdf engines on synthetic CSV files")
+    print("Usage: \n $ python -m benchmark.run -g [GRAMMAR] [--rows N1,N2,...]")
+    print("'--modes M1,M2,...' among: " + ", ".join(MODES))
+    print("    default: " + ",".join(DEFAULT_MODES))
+    print("'--workdir DIR' folder of the CSV files and outputs (default 'bench')")
+    print("'--output FILE' JSON results (default " + RESULTS + ")")
+    print("'--card NAME=N', '--miss R', '--empty R': see benchmark.generate")
+    print("'--no-count' does not count the triples of the outputs")
+    sys.exit(0)
+
+
+#================================================= main
+def main():
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "g:h",
+                                   ["grammar=", "rows=", "modes=", "workdir=",
+                                    "output=", "card=", "miss=", "empty=",
+                                    "no-count", "help"])
+    except getopt.GetoptError:
+        usage()
+    grammar = os.path.join(HERE, "mipl-grammar-em.ini")
+    sizes = DEFAULT_ROWS
+    modes = DEFAULT_MODES
+    workdir = "bench"
+    output = RESULTS
+    cards = []
+    missrate = MISS_RATE
+    emptyrate = EMPTY_RATE
+    count = True
+    for o, a in opts:
+        if o in ("-h", "--help"):
+            usage()
+        if o in ("-g", "--grammar"):
+            grammar = a
+        if o == "--rows":
+            sizes = [int(n) for n in a.split(',')]
+        if o == "--modes":
+            modes = a.split(',')
+        if o == "--workdir":
+            workdir = a
+        if o == "--output":
+            output = a
+        if o == "--card":
+            cards.append(a)
+        if o == "--miss":
+            missrate = float(a)
+        if o == "--empty":
+            emptyrate = float(a)
+        if o == "--no-count":
+            count = False
+    for mode in modes:
+        if mode not in MODES:
+            print("Unknown mode: " + mode)
+            usage()
+    results = benchmark(grammar, sizes, modes, workdir, parse_cards(cards),
+                        missrate, emptyrate, count)
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump({"date": datetime.now().isoformat(timespec='seconds'),
+                   "python": platform.python_version(),
+                   "machine": platform.machine(),
+                   "cpus": os.cpu_count(),
+                   "grammar": os.path.abspath(grammar),
+                   "miss_rate": missrate,
+                   "empty_rate": emptyrate,
+                   "results": results}, f, indent=2)
+    print("Results written into " + output)
+
+
+if __name__ == '__main__':
+    main()
@@ -6,8 +6,12 @@
 #============================================
 #!/usr/bin/env python3
 
-import getopt, sys, csv, configparser, os.path, traceback, time, os
+import getopt, sys, csv, configparser, os.path, traceback, time, os, shutil
+import hashlib, json, sqlite3, re
 from os.path import exists
+from functools import lru_cache
+from itertools import islice
+from concurrent.futures import ProcessPoolExecutor, CancelledError
 
 #Conditional import
 try:
@@ -15,12 +19,31 @@ try:
 except ImportError:
     import progressbar as progressbar2 #Windows
 
+#Optional import: columnar engine, only loaded by '--engine columnar'
+#(pandas adds about 50 MB to the memory of every run)
+pandas = None
+def load_pandas():
+    '''
+    Returns False if pandas is not installed
+    '''
+    global pandas
+    try:
+        import pandas
+    except ImportError:
+        return False
+    return True
+
 from rdflib import Graph, Literal, URIRef, RDF, RDFS, BNode, XSD
 from datetime import date, timedelta
 
 import sys
 sys.path.append('.')
-from tools import myprint, Timer, interrupt, countLinesInCSVFile
+from tools import myprint, Timer, interrupt, countLinesInCSVFile, set_console, \
+    set_log, append_log, CSVRecords, split_csv, init_log, close_log, RowIndex, \
+    init_profile, profile_prefix, profile_phase, profile_report, \
+    open_output, is_compressed, COMPRESSIONS, GZIP, ZSTD, zstandard, \
+    init_memory, stop_memory, memory_every, memory_snapshot, memory_report, \
+    WARNING, ERROR, LEVELS, INFO, FULL, LIGHT
 
 #ENCODING = "utf8"
 ENCODING = "latin_1"
@@ -31,12 +54,27 @@ DOMAIN = 'domain'
 DELIMITER = 'delimiter'
 SEMANTICS = 'semantics'
 ACTIVE = 'active'
+#----------------------------------------- Optional fields per csv file
+BACKEND = 'backend'
+
+#------------------------------------------------- Store backends
+MEMORY = 'memory'     # rdflib Graph, dumped in Turtle
+NTRIPLES = 'ntriples' # streamed N-Triples file
+SQLITE = 'sqlite'     # SQLite SPO table
+BACKENDS = [MEMORY, NTRIPLES, SQLITE]
+
+#------------------------------------------------- Conversion engines
+ROWS = 'rows'         # row by row, semantic_parser
+COLUMNAR = 'columnar' # batches of rows, ColumnarEngine (requires pandas)
+ENGINES = [ROWS, COLUMNAR]
 
 #------------------------------------------------- Grammar fields: keys
 MULTITREATMENT = '$'
 CELLROLE = 'cellrole'
 CELLTYPE = 'celltype'
 COLUMNTYPE = 'columntype'
+ONMISS = 'onmiss' # optional: policy of the map misses
+MEMO = 'memo'     # optional: size of the memo of a URI column, 0 for none
 
 #------------------------------------------------- Grammar fields: values
 IGNORE = 'ignore'
@@ -59,6 +97,36 @@ MAP_ALL = 1
 MAP_PART = 2
 EXTRACT = 3
 PREFIX = 4
+REGEX = 5
+REGEX_MAP = 6
+MAP_PREFIX = 7
+ALTER_NAMES = {NONE: "none", MAP_ALL: "map all", MAP_PART: "map part",
+               EXTRACT: "extract", PREFIX: "prefix", REGEX: "regex",
+               REGEX_MAP: "regex map", MAP_PREFIX: "map prefix"}
+# modes whose cell values may miss (map key not found, regex not matching)
+MISS_MODES = (MAP_ALL, MAP_PART, REGEX, REGEX_MAP, MAP_PREFIX)
+# modes computed by URIColumn.match_value, memoised per distinct value
+MATCH_MODES = (REGEX, REGEX_MAP, MAP_PREFIX)
+
+#--- Map miss policies: 'onmiss = keep', 'onmiss = drop', 'onmiss = default(value)'
+KEEP = 'keep'       # the raw cell value is used (default)
+DROP = 'drop'       # no triple is generated for the cell
+DEFAULT = 'default' # the default value is used
+
+
+#================================================= Errors
+class GrammarError(Exception):
+    '''
+    Grammar file not valid or not matching the CSV header: the source
+    cannot be converted, the other sources can
+    '''
+    pass
+
+class ErrorBudgetExceeded(Exception):
+    '''
+    More rows quarantined than allowed by '--max-errors': the run is aborted
+    '''
+    pass
 
 
 #================================================= format_date: not used
@@ -72,30 +140,62 @@ def date_stamp(store, domain, URI):
 
 #================================================= to-define-in-ontology
 ONTO_REQ = "to-define-in-ontology.txt"
-DEFINE = []
+ONTO_STUB = "to-define-in-ontology.ttl"
+CELL_TYPE = "Cell type"
+COLUMN_TYPE = "Column type"
+
+class OntologyRegistry():
+    '''
+    Cell types and column types that should be defined in the ontology.
+    Types are registered when a grammar is compiled (Grammar.__init__),
+    the row loop does not touch the registry.
+    self.entries = { (kind, URI): [label, count], ... } in insertion order,
+    count being the number of grammar columns using the type
+    '''
+    def __init__(self):
+        self.entries = {}
+    def register(self, kind, uri, label, count=1):
+        key = (kind, uri)
+        if key in self.entries:
+            self.entries[key][1] += count
+        else:
+            self.entries[key] = [label, count]
+    def merge(self, other):
+        # used to gather the registries of the worker processes
+        for (kind, uri), (label, count) in other.entries.items():
+            self.register(kind, uri, label, count)
+    def dump(self, filename=ONTO_REQ, stubname=ONTO_STUB):
+        # 1. list of the types to define
+        with open(filename, 'w', encoding=ENCODING, newline='\n') as output:
+            for (kind, uri) in self.entries:
+                output.write(kind + ": " + uri.n3() + '\n')
+        # 2. ready to edit Turtle stub
+        with open(stubname, 'w', encoding='utf-8', newline='\n') as output:
+            output.write("@prefix rdf: <" + str(RDF) + "> .\n")
+            output.write("@prefix rdfs: <" + str(RDFS) + "> .\n")
+            for (kind, uri), (label, count) in self.entries.items():
+                rdftype = "rdfs:Class" if kind == CELL_TYPE else "rdf:Property"
+                output.write("\n# " + kind + " used by " + str(count)
+                             + " grammar column(s)\n")
+                output.write(uri.n3() + " a " + rdftype + " ;\n")
+                output.write("    rdfs:label " + Literal(label).n3() + " .\n")
 
-def to_define_in_ontology(*args):
-    global DEFINE
-    for str in args:
-        if str not in DEFINE:
-            DEFINE.append(str)
+ONTOLOGY = OntologyRegistry()
 
 def dump_define():
-    global DEFINE
-    with open(ONTO_REQ, 'w', encoding=ENCODING, newline='\n') as output:
-        for str in DEFINE:
-            output.write(str + '\n')
+    ONTOLOGY.dump()
 
 
 #============================================ Source
 class Source():
-    def __init__(self, name, file, domain, delim, semantics, active):
+    def __init__(self, name, file, domain, delim, semantics, active, backend=MEMORY):
         self.name = name
         self.file = file
         self.domain = domain
         self.delim = delim
         self.semanticfile = semantics
         self.active = active
+        self.backend = backend
     def print(self):
         myprint("-----------")
         myprint("Source: " +  self.name)
@@ -104,6 +204,7 @@ class Source():
         myprint("Delim: " + self.delim)
         myprint("Active: " + str(self.active))
         myprint("Semantics: " + self.semanticfile)
+        myprint("Backend: " + self.backend)
 
 
 #============================================ Options: main conf file
@@ -128,7 +229,13 @@ class Options():
                                     config[elem][DOMAIN],
                                     config[elem][DELIMITER],
                                     config[elem][SEMANTICS],
-                                    config[elem][ACTIVE])
+                                    config[elem][ACTIVE],
+                                    config[elem].get(BACKEND, MEMORY))
+                    if source.backend not in BACKENDS:
+                        myprint("Warning: unknown backend '" + source.backend
+                                + "' for source " + elem + ", using '"
+                                + MEMORY + "'", WARNING)
+                        source.backend = MEMORY
                     self.sources.append(source)
         myprint("Config file read: found "
               + str(len(config.sections()))
@@ -158,29 +265,416 @@ class RDFStore():
     def dump(self):
         myprint("Dumping store")
         tim = Timer()
-        self.store.serialize(self.name, format='turtle')
+        if is_compressed(self.name):
+            with open_output(self.name, binary=True) as output:
+                self.store.serialize(destination=output, format='turtle')
+        else:
+            self.store.serialize(self.name, format='turtle')
         tim.stop()
         myprint("Store dumped")
 
 
+#================================================= N-Triples formatting
+# the same escaping in one pass, for the columns (ColumnarEngine)
+NT_ESCAPE = str.maketrans({'\\': '\\\\', '"': '\\"', '\n': '\\n', '\r': '\\r'})
+
+def nt_escape(value):
+    return (value.replace('\\', '\\\\')
+                 .replace('"', '\\"')
+                 .replace('\n', '\\n')
+                 .replace('\r', '\\r'))
+
+def nt_term(term):
+    '''
+    Term in N-Triples syntax. Literal.n3() is not used because it produces
+    Turtle long strings for values containing new lines.
+    Note: '%' formatting is used because '+' on a URIRef builds a new URIRef.
+    '''
+    if isinstance(term, Literal):
+        if term.language is not None:
+            return '"%s"@%s' % (nt_escape(term), term.language)
+        if term.datatype is not None:
+            return '"%s"^^<%s>' % (nt_escape(term), term.datatype)
+        return '"%s"' % nt_escape(term)
+    if isinstance(term, BNode):
+        return '_:%s' % term
+    return '<%s>' % term
+
+
+#================================================= NTriplesStore
+class NTriplesStore():
+    '''
+    Streaming store: each triple is written as soon as it is added
+    into a buffered N-Triples file (or stdout), no Graph is built.
+    Memory stays flat whatever the size of the CSV file.
+    Duplicate triples are not filtered (N-Triples loaders accept them).
+    A name ending with .gz or .zst gives a compressed stream (see tools).
+    '''
+    BUFFER = 1024 * 1024
+    def __init__(self, name, stdout=False, resume=None):
+        # Expecting name to be something like "toto.nt"
+        # resume = (size, count): a partial file is truncated to size bytes
+        # and continued
+        self.name = name
+        self.stdout = stdout
+        self.count = 0
+        if stdout:
+            self.output = sys.stdout
+        elif resume is not None:
+            (size, self.count) = resume
+            os.truncate(name, size)
+            self.output = open(name, 'a', encoding='utf-8', newline='\n',
+                               buffering=self.BUFFER)
+        else:
+            self.output = open_output(name, buffering=self.BUFFER)
+        self.write = self.output.write
+    def add(self, triple):
+        (s, p, o) = triple
+        self.write('%s %s %s .\n' % (nt_term(s), nt_term(p), nt_term(o)))
+        self.count += 1
+    def flush(self):
+        '''
+        Returns the size in bytes of the output written so far
+        '''
+        self.output.flush()
+        os.fsync(self.output.fileno())
+        return os.fstat(self.output.fileno()).st_size
+    def dump(self):
+        self.output.flush()
+        if not self.stdout:
+            self.output.close()
+        myprint("Stream closed: " + str(self.count) + " triples written to "
+                + ("stdout" if self.stdout else self.name))
+
+
+#================================================= SQLiteStore
+class SQLiteStore():
+    '''
+    Disk-backed store: one SPO table in a SQLite file, the terms being
+    kept in N-Triples syntax. Triples are inserted by batches of BATCH,
+    one transaction per batch, and the POS and OSP indexes are built at
+    the end of the load. The file can be queried with SQL, e.g.
+    SELECT s FROM triples WHERE p = '<...#type>' AND o = '<...pnr>'
+    '''
+    BATCH = 50000
+    def __init__(self, name):
+        # Expecting name to be something like "toto.sqlite"
+        self.name = name
+        self.count = 0
+        if os.path.isfile(name):
+            os.remove(name)
+        self.db = sqlite3.connect(name)
+        self.db.execute("PRAGMA journal_mode = OFF")
+        self.db.execute("PRAGMA synchronous = OFF")
+        self.db.execute("CREATE TABLE triples (s TEXT, p TEXT, o TEXT, "
+                        "PRIMARY KEY (s, p, o)) WITHOUT ROWID")
+        self.batch = []
+    def add(self, triple):
+        (s, p, o) = triple
+        self.batch.append((nt_term(s), nt_term(p), nt_term(o)))
+        self.count += 1
+        if len(self.batch) >= self.BATCH:
+            self.commit()
+    def commit(self):
+        with self.db:
+            self.db.executemany("INSERT OR IGNORE INTO triples VALUES (?, ?, ?)",
+                                self.batch)
+        self.batch = []
+    def dump(self):
+        myprint("Indexing store")
+        tim = Timer()
+        self.commit()
+        with self.db:
+            self.db.execute("CREATE INDEX triples_pos ON triples (p, o, s)")
+            self.db.execute("CREATE INDEX triples_osp ON triples (o, s, p)")
+        # from now on, count is the number of distinct triples of the file
+        self.count = self.db.execute("SELECT COUNT(*) FROM triples").fetchone()[0]
+        self.db.close()
+        tim.stop()
+        myprint("Store closed: " + str(self.count) + " distinct triples in " + self.name)
+
+
+#================================================= make_store
+def make_store(name, backend, stdout=False, compression=""):
+    '''
+    Store factory: name is the name of the output without extension,
+    compression is "", GZIP or ZSTD (not for SQLite)
+    '''
+    if backend == NTRIPLES:
+        return NTriplesStore(name + ".nt" + compression, stdout)
+    if backend == SQLITE:
+        return SQLiteStore(name + ".sqlite")
+    return RDFStore(name + ".ttl" + compression)
+
+
+#================================================= store_size
+def store_size(store):
+    '''
+    Number of triples added to a store so far, the number of distinct
+    triples once a SQLite store is dumped
+    '''
+    if isinstance(store, RDFStore):
+        return len(store.get_store())
+    return getattr(store, "count", None)
+
+
+#================================================= TripleCollector
+class TripleCollector():
+    '''
+    Store keeping the triples in memory, in insertion order and without
+    duplicates. Used to compute deltas on small sets of rows.
+    '''
+    def __init__(self):
+        self.triples = {}
+    def add(self, triple):
+        self.triples[triple] = None
+    def __iter__(self):
+        return iter(self.triples)
+    def __contains__(self, triple):
+        return triple in self.triples
+
+
 
 #================================================= format_predicate
+# Characters replaced by '_' in URIs, compiled once into a translation table
+URI_UNSAFE = [' ', '-', '/', '\\', '(',')',',',
+              '"', "'", "<", ">", "|", "{", "}",
+              "^", "#", "$", "*", ".", "`", "+",
+              "=", "%"]
+# The control characters (new lines of multi-line cells, tabs...), forbidden
+# in the IRIs of N-Triples and Turtle, are percent-encoded
+URI_CONTROLS = {chr(c): '%%%02X' % c for c in range(0x20) if chr(c) not in URI_UNSAFE}
+URI_TABLE = str.maketrans({**dict.fromkeys(URI_UNSAFE, '_'), **URI_CONTROLS})
+
 def format_URI(pred):
-    new = ''
-    for i, c in enumerate(pred):
-        if c in [' ', '-', '/', '\\', '(',')',',',
-                 '"', "'", "<", ">", "|", "{", "}",
-                 "^", "#", "$", "*", ".", "`", "+",
-                 "=", "%"]:
-            new += '_'
+    return pred.translate(URI_TABLE)
+
+
+#================================================= URIMinter
+class URIMinter():
+    '''
+    Shared term factory of PKey, URIColumn and LiteralColumn.
+    Terms are built once and kept in bounded LRU caches:
+    - uri(domain, raw value) -> URIRef(domain + format_URI(raw value))
+    - literal(value, datatype) -> Literal(value, datatype=datatype)
+    The caches only have to hold the values repeated in nearby rows: the
+    frequent values of a column are kept by its memo (URIColumn.terms).
+    With track (set by '--report'), sanitisation collisions ('a-b' and
+    'a b' both giving 'a_b') are counted for the first MAXSEEN distinct
+    URIs: this costs about 12 MB per 100000 URIs.
+    '''
+    MAXSIZE = 20000
+    MAXSEEN = 100000
+    def __init__(self, maxsize=MAXSIZE, track=False):
+        self.maxsize = maxsize
+        self.track = track
+        # self.seen = { URI: first raw value }, only filled with track
+        self.seen = {}
+        self.collisions = 0
+        self.examples = []
+        self.init_caches()
+    def init_caches(self):
+        self.uri = lru_cache(maxsize=self.maxsize)(self.mint_uri)
+        self.literal = lru_cache(maxsize=self.maxsize)(self.mint_literal)
+    #--- the caches are not sent to the worker processes
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['uri']
+        del state['literal']
+        return state
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.init_caches()
+    def mint_uri(self, domain, raw):
+        uri = domain + raw.translate(URI_TABLE)
+        if not self.track:
+            return URIRef(uri)
+        if uri in self.seen:
+            if self.seen[uri] != raw:
+                self.collisions += 1
+                if len(self.examples) < 10:
+                    self.examples.append((self.seen[uri], raw, uri))
+        elif len(self.seen) < self.MAXSEEN:
+            self.seen[uri] = raw
+        return URIRef(uri)
+    def mint_literal(self, value, datatype=None):
+        return Literal(value, datatype=datatype)
+    def report(self):
+        uris = self.uri.cache_info()
+        lits = self.literal.cache_info()
+        myprint("URI cache: " + str(uris.hits) + " hits, "
+                + str(uris.misses) + " misses - Literal cache: "
+                + str(lits.hits) + " hits, " + str(lits.misses) + " misses")
+        if self.collisions != 0:
+            myprint("Warning: " + str(self.collisions)
+                    + " sanitisation collision(s) in URIs", WARNING)
+            for (first, other, uri) in self.examples:
+                myprint("  '" + first + "' and '" + other + "' both give " + uri)
+
+
+#================================================================ MapTable
+class MapTable():
+    '''
+    External map table of a map() command, 'map(all;@codes.csv)': the
+    table is not loaded in memory. A CSV file of 'key;value' lines (the
+    delimiter of the source, '#' for comments) is indexed once into a
+    SQLite file [FILE].map.sqlite, rebuilt when the CSV file changes; the
+    keys are lowercased at that time. A '.sqlite' file is used as is: it
+    must have the table of the index, map (key TEXT PRIMARY KEY, value TEXT),
+    with lowercased keys. Lookups go through a bounded LRU cache.
+    Supports 'key in table', 'table[key]' and 'table.get(key)'.
+    '''
+    MAXSIZE = 100000 # keys kept in the LRU cache
+    BATCH = 50000    # rows inserted per transaction when indexing
+    def __init__(self, filename, delim, maxsize=MAXSIZE):
+        self.filename = filename
+        self.delim = delim
+        self.maxsize = maxsize
+        if filename.endswith(".sqlite"):
+            self.index = filename
         else:
-            new += pred[i]
-    return new
+            self.index = filename + ".map.sqlite"
+            self.build()
+        self.db = None
+        self.init_cache()
+    def init_cache(self):
+        self.get = lru_cache(maxsize=self.maxsize)(self.lookup)
+    #--- the connection and the cache are not sent to the worker processes
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['db'] = None
+        del state['get']
+        return state
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.init_cache()
+    def stamp(self):
+        stat = os.stat(self.filename)
+        return str(stat.st_size) + ":" + str(stat.st_mtime_ns)
+    def build(self):
+        '''
+        Indexes the CSV file unless the index matches its size and date
+        '''
+        if os.path.isfile(self.index):
+            db = sqlite3.connect(self.index)
+            try:
+                row = db.execute("SELECT value FROM meta WHERE key = 'stamp'").fetchone()
+            except sqlite3.Error:
+                row = None
+            db.close()
+            if row is not None and row[0] == self.stamp():
+                return
+        myprint("Indexing map table " + self.filename + " into " + self.index)
+        tim = Timer()
+        # one temporary file per process (--jobs, --split), the index being
+        # replaced at once by the last process done
+        temp = self.index + "." + str(os.getpid()) + ".tmp"
+        if os.path.isfile(temp):
+            os.remove(temp)
+        db = sqlite3.connect(temp)
+        db.execute("PRAGMA journal_mode = OFF")
+        db.execute("PRAGMA synchronous = OFF")
+        db.execute("CREATE TABLE map (key TEXT PRIMARY KEY, value TEXT) WITHOUT ROWID")
+        db.execute("CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT)")
+        nb = 0
+        batch = []
+        with open(self.filename, 'r', encoding='utf-8', errors='ignore', newline='') as f:
+            for row in csv.reader(f, delimiter=self.delim):
+                if len(row) < 2 or row[0].startswith('#'):
+                    continue
+                batch.append((row[0].strip().lower(), row[1].strip()))
+                if len(batch) >= self.BATCH:
+                    with db:
+                        db.executemany("INSERT OR REPLACE INTO map VALUES (?, ?)", batch)
+                    nb += len(batch)
+                    batch = []
+        with db:
+            db.executemany("INSERT OR REPLACE INTO map VALUES (?, ?)", batch)
+            db.execute("INSERT INTO meta VALUES ('stamp', ?)", (self.stamp(),))
+        nb += len(batch)
+        db.close()
+        os.replace(temp, self.index)
+        tim.stop()
+        myprint(str(nb) + " entries indexed")
+    def connect(self):
+        if self.db is None:
+            if not os.path.isfile(self.index):
+                raise FileNotFoundError('Map table "' + self.index + '" not found.')
+            self.db = sqlite3.connect(self.index)
+        return self.db
+    def lookup(self, key):
+        row = self.connect().execute("SELECT value FROM map WHERE key = ?",
+                                     (key,)).fetchone()
+        return None if row is None else row[0]
+    def items(self):
+        # all the entries, read from the index (see PrefixTable)
+        return self.connect().execute("SELECT key, value FROM map")
+    def __contains__(self, key):
+        return self.get(key) is not None
+    def __getitem__(self, key):
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+    def report(self):
+        info = self.get.cache_info()
+        myprint("Map table " + os.path.basename(self.filename) + ": "
+                + str(info.hits) + " cache hits, " + str(info.misses) + " lookups")
+
+
+#================================================================ PrefixTable
+class PrefixTable():
+    '''
+    Keys of a map table looked up by prefix: the entries in a dict and
+    the distinct lengths of the keys, longest first. longest(text)
+    returns the value of the longest key prefixing text, in at most one
+    lookup per key length. A MapTable is read once into the dict.
+    '''
+    def __init__(self, table):
+        self.table = table if isinstance(table, dict) else dict(table.items())
+        self.size = len(self.table)
+        self.lengths = sorted(set(map(len, self.table)), reverse=True)
+    def longest(self, text):
+        size = len(text)
+        for length in self.lengths:
+            if length <= size:
+                value = self.table.get(text[:length])
+                if value is not None:
+                    return value
+        return None
+
+
+#================================================================ split_commands
+def split_commands(cellrole):
+    '''
+    Splits a cellrole on the commas that are not between parentheses,
+    a backslash protecting the next character (regular expressions):
+    'object,regex(^(\\w{1,3})-;\\1_)' -> ['object', 'regex(^(\\w{1,3})-;\\1_)']
+    '''
+    commands = []
+    depth = 0
+    start = 0
+    escaped = False
+    for i, char in enumerate(cellrole):
+        if escaped:
+            escaped = False
+        elif char == '\\':
+            escaped = True
+        elif char == '(':
+            depth += 1
+        elif char == ')':
+            depth -= 1
+        elif char == ',' and depth == 0:
+            commands.append(cellrole[start:i])
+            start = i + 1
+    commands.append(cellrole[start:])
+    return commands
 
 
 #================================================================ Column, root class
 class Column():
-    def __init__(self, domain, columnname, lists, cellrole, celltype, columntype, ispkey = False):
+    def __init__(self, domain, columnname, lists, cellrole, celltype, columntype,
+                 ispkey = False, minter = None):
         self.domain = domain
         #name of the column in CSV must begin by the same
         #(case of the $x en of sections)
@@ -191,159 +685,419 @@ class Column():
         self.columntype = columntype
         self.ispkey = ispkey
         self.csvindex = -1
-    def generate_triples(self, store, cellvalue, pkeyvalue, pkeytype):
+        self.minter = minter if minter is not None else URIMinter()
+    def register(self, registry):
+        pass
+    def generate_schema(self, store, pkeytype):
         pass
+    def plan(self, ns, n):
+        '''
+        Execution plan of the column (see Grammar.compile_plan): Python
+        source lines run for a non empty cell value 'v' of the row, 'pk'
+        being the pkey URI. Row independent terms are stored in the
+        namespace ns under names suffixed by the column number n.
+        '''
+        return []
 
 
 #================================================================ PKey
 class PKey(Column):
-    # for this class, cellvalue and pkvalue are identical, pkeyvalue is not used
-    def generate_triples(self, store, cellvalue, pkeyvalue, pkeytype):
-        # 1. format the predicate because the value can be dirty
-        cellvalueURI  = URIRef(self.domain + format_URI(cellvalue))
-        celltypeURI   = URIRef(self.domain + format_URI(self.celltype))
-        
-        # 2. associate original values as a label
-        store.add(( cellvalueURI, RDFS.label, Literal(cellvalue)))
-        store.add(( celltypeURI,  RDFS.label, Literal(self.celltype)))
-        
-        # 3. to keep track of the ontology definitions required
-        to_define_in_ontology("Cell type: " + celltypeURI.n3())
-
-        # 4. Type the pkey
-        store.add(( cellvalueURI, RDF.type, celltypeURI))
+    def __init__(self, domain, name, lists, cellrole, celltype, columntype,
+                 pkey = True, minter = None):
+        super().__init__(domain, name, lists, cellrole, celltype, columntype, True, minter)
+        self.celltypeURI = self.minter.uri(self.domain, self.celltype)
+
+    #--------------to keep track of the ontology definitions required
+    def register(self, registry):
+        registry.register(CELL_TYPE, self.celltypeURI, self.celltype)
+
+    #--------------generate schema: once per grammar
+    def generate_schema(self, store, pkeytype):
+        # describe the celltype
+        store.add(( self.celltypeURI, RDFS.label, Literal(self.celltype)))
+
+    #--------------execution plan
+    def plan(self, ns, n):
+        ns['T%d' % n] = self.celltypeURI
+        return ["u = uri(D, v)",
+                "add((u, LABEL, lit(v)))",
+                "add((u, TYPE, T%d))" % n]
 
 
 #================================================================ PKey
 class URIColumn(Column):
-    def __init__(self, domain, name, lists, cellrole, celltype, columntype, pkey = False):
-        super().__init__(domain, name, lists, cellrole, celltype, columntype, False)
+    TOKENS = 100000 # distinct cell values whose tokens are cached (split)
+    #--- memo of the terms of the cell values, see terms
+    MEMOSIZE = 100000 # default size
+    MEMOPROBE = 10000 # lookups before the hit rate is checked
+    MEMORATE = 0.5    # minimal hit rate, the memo is disabled below
+    def __init__(self, domain, name, lists, cellrole, celltype, columntype,
+                 pkey = False, minter = None, onmiss = KEEP, memo = MEMOSIZE):
+        super().__init__(domain, name, lists, cellrole, celltype, columntype, False, minter)
         self.altermode = NONE
         self.maptable = None
+        self.mapname = None
         self.myinfchar = -1
         self.mymaxchar = -1
         self.prefix = ""
+        self.regex = None
+        self.template = None
+        self.prefixes = None
+        self.split = False
+        self.separator = None
+        # LRU cache cell value -> terms, created with the plan, disabled
+        # for the columns with too many distinct values (check_memo)
+        self.memosize = memo
+        self.memo = None
+        self.memooff = False
+        self.memoinfo = None # counts of the memo when it was disabled
+        # number of cell values not found in the map table
+        self.misses = 0
+        # self.missed = { map key not found: number of cells }
+        self.missed = {}
+        # policy of the misses
+        self.onmiss = KEEP
+        self.default = None
+        if onmiss.startswith(DEFAULT + "(") and onmiss.endswith(")"):
+            self.onmiss = DEFAULT
+            self.default = onmiss[len(DEFAULT) + 1:-1]
+        elif onmiss in (KEEP, DROP):
+            self.onmiss = onmiss
+        else:
+            raise GrammarError("Unknown " + ONMISS + " policy: '" + onmiss
+                               + "' in grammar section " + name)
+        self.celltypeURI   = self.minter.uri(self.domain, self.celltype)
+        self.columntypeURI = self.minter.uri(self.domain, self.columntype)
         # management of alteration of cell value
-        cellgrammar = self.cellrole.split(',')
-        if len(cellgrammar) != 1:
+        cellgrammar = split_commands(self.cellrole)
+        # MODIFIER: 'split(sep)' cuts the cell value into tokens, each token
+        # being altered and generating its triples ('split()': on blanks)
+        commands = []
+        for command in cellgrammar[1:]:
+            if command.startswith("split("):
+                self.split = True
+                self.separator = command[6:-1] or None
+            else:
+                commands.append(command)
+        if len(commands) > 1:
+            raise GrammarError("Only one alteration command is allowed (with split)"
+                               " in grammar section " + name)
+        for command in commands:
             # ALTER 1: mapping the value of the cell
             # or the value of a part of the cell with a key/value list
-            if cellgrammar[1].startswith("map("):
-                args = (cellgrammar[1][4:-1]).split(';')
-                # expecting 2 arguments 'all;*suppliers*' or '1:2;*configs*'
+            if command.startswith("map("):
+                args = (command[4:-1]).split(';')
+                # expecting 2 arguments 'all;*suppliers*', '1:2;*configs*'
+                # or 'prefix;*families*'
+                # or an external table 'all;@suppliers.csv' (MapTable)
+                if args[1] not in lists:
+                    raise GrammarError("Unknown list '" + args[1]
+                                       + "' in grammar section " + name)
                 self.maptable = lists[args[1]] #getting dict - dict object
+                self.mapname = args[1]
                 if args[0] == 'all':
                     self.altermode = MAP_ALL
+                elif args[0] == 'prefix':
+                    # longest key of the list prefixing the cell value
+                    self.prefixes = PrefixTable(self.maptable)
+                    self.altermode = MAP_PREFIX
                 else:
                     [myinf,mymax] = args[0].split(":")
                     self.myinfchar = int(myinf) if (myinf != "") else 0
                     self.mymaxchar = int(mymax) if (mymax != "") else 0
                     self.altermode = MAP_PART
             # ALTER 2: extracting info from the cell value itself
-            elif cellgrammar[1].startswith("extract("):
-                args = cellgrammar[1][8:-1] #expecting one argument '-3:' or '1:2'
+            elif command.startswith("extract("):
+                args = command[8:-1] #expecting one argument '-3:' or '1:2'
                 [myinf,mymax] = args.split(":")
                 self.myinfchar = int(myinf) if (myinf != "") else 0
                 self.mymaxchar = int(mymax) if (mymax != "") else 0
                 self.altermode = EXTRACT
             # ALTER 3: adding a prefix to the cell value
-            elif cellgrammar[1].startswith("prefix("):
-                self.prefix = cellgrammar[1][7:-1] #expecting one arg such as 'toto_' or 'gnu_'
+            elif command.startswith("prefix("):
+                self.prefix = command[7:-1] #expecting one arg such as 'toto_' or 'gnu_'
                 self.altermode = PREFIX
+            # ALTER 4: rewriting the cell value with a regular expression
+            # 'regex(^PN-0*(\d+)$;P\1)': first match replaced by the template
+            elif command.startswith("regex("):
+                (pattern, _, self.template) = command[6:-1].rpartition(';')
+                self.regex = self.compile_regex(pattern, name)
+                self.mapname = "regex(" + pattern + ")"
+                self.altermode = REGEX
+            # ALTER 5: mapping the first group (or the match) of a regular expression
+            # 'regexmap(^([A-Z]+)\d;*configs*)'
+            elif command.startswith("regexmap("):
+                (pattern, _, listname) = command[9:-1].rpartition(';')
+                if listname not in lists:
+                    raise GrammarError("Unknown list '" + listname
+                                       + "' in grammar section " + name)
+                self.regex = self.compile_regex(pattern, name)
+                self.maptable = lists[listname]
+                self.mapname = listname
+                self.altermode = REGEX_MAP
             else:
-                myprint("Error: Unknown command: '" + cellgrammar[1]
-                      + "' in grammar file. Exiting...")
-                exit(0)            
+                raise GrammarError("Unknown command: '" + command
+                                   + "' in grammar section " + name)
+    def compile_regex(self, pattern, name):
+        try:
+            return re.compile(pattern)
+        except re.error as e:
+            raise GrammarError("Invalid regular expression '" + pattern
+                               + "' in grammar section " + name + ": " + str(e))
+
     #--- Alter modes
     def alter_cell_value(self, cellvalue):
+        '''
+        Returns the altered cell value, None if the cell should not
+        generate triples. The map misses are counted.
+        '''
+        (value, key) = self.alter_value(cellvalue)
+        if key is not None:
+            self.count_miss(key)
+        return value
+
+    def alter_value(self, cellvalue):
+        '''
+        Returns (altered value, miss key), the miss key being None if the
+        value was found in the map table (or for the modes without map)
+        '''
         if cellvalue.strip() == "":
-            return "" #TODO: ne pas créer de triple si la cellule est vide
+            return ("", None) #TODO: ne pas créer de triple si la cellule est vide
         if self.altermode == NONE:
-            return cellvalue
+            return (cellvalue, None)
         # ALTER 1: mapping the value of the cell
         if self.altermode == MAP_ALL:
             if cellvalue.lower() in self.maptable: #TODO: regarder la cohérence de "lower"
-                return self.maptable[cellvalue.lower()]
+                return (self.maptable[cellvalue.lower()], None)
             else:
-                myprint("Warning: " + cellvalue + " not in maptable")
-                return cellvalue #unmapped
+                return (self.miss_value(cellvalue), cellvalue.lower())
         if self.altermode == MAP_PART:
             temp = cellvalue[self.myinfchar:self.mymaxchar].lower()
             if temp in self.maptable:
-                return self.maptable[temp]
+                return (self.maptable[temp], None)
             else:
-                myprint("Warning: " + cellvalue + " not in maptable")
-                return cellvalue #unmapped
+                return (self.miss_value(cellvalue), temp)
         # ALTER 2: extracting info from the cell value itself
         if self.altermode == EXTRACT:
-            return cellvalue[self.myinfchar:self.mymaxchar]
+            return (cellvalue[self.myinfchar:self.mymaxchar], None)
         # ALTER 3: adding a prefix to the cell value
         if self.altermode == PREFIX:
-            return cellvalue + self.prefix
-        myprint("Error: we should never get here!")
-            
-    #--------------generate triples
-    def generate_triples(self, store, cellvalue, pkeyvalue, pkeytype):
-        # 0. managing the commands of alteration 
-        newcellvalue = self.alter_cell_value(cellvalue)
-
-        # 1. generate all URIs
-        cellvalueURI  = URIRef(self.domain + format_URI(newcellvalue))
-        celltypeURI   = URIRef(self.domain + format_URI(self.celltype))
-        columntypeURI = URIRef(self.domain + format_URI(self.columntype))
-
-        pkeyvalueURI = URIRef(self.domain + format_URI(pkeyvalue))
-        pkeytypeURI  = URIRef(self.domain + format_URI(pkeytype))
-        
-        # 2. capture the rough string values in Literal
-        store.add((cellvalueURI,  RDFS.label, Literal(newcellvalue)))
-        store.add((celltypeURI,   RDFS.label, Literal(self.celltype)))
-        store.add((columntypeURI, RDFS.label, Literal(self.columntype)))
-        
-        # 3. to keep track of the ontology definitions required
-        to_define_in_ontology("Cell type: " + celltypeURI.n3(),
-                              "Column type: " + columntypeURI.n3())
-
-        # 4. type the cell value
-        store.add((cellvalueURI, RDF.type, celltypeURI))
-
-        # 5. create the real triple + domain/range
+            return (cellvalue + self.prefix, None)
+        # ALTER 4 and 5: regular expressions, and longest prefix maps
+        if self.altermode in MATCH_MODES:
+            (value, key) = self.match_value(cellvalue)
+            if key is not None:
+                return (self.miss_value(cellvalue), key)
+            return (value, None)
+        myprint("Error: we should never get here!", ERROR)
+
+    def match_value(self, cellvalue):
+        '''
+        Returns (altered value, None), or (None, miss key) if the regular
+        expression does not match or if the map table has no such key
+        '''
+        if self.altermode == MAP_PREFIX:
+            key = cellvalue.lower()
+            value = self.prefixes.longest(key)
+            return (value, None) if value is not None else (None, key)
+        if self.altermode == REGEX:
+            (value, nb) = self.regex.subn(self.template, cellvalue, count=1)
+            return (value, None) if nb != 0 else (None, cellvalue)
+        match = self.regex.search(cellvalue)
+        if match is None:
+            return (None, cellvalue)
+        key = (match.group(1) if self.regex.groups else match.group(0)).lower()
+        if key in self.maptable:
+            return (self.maptable[key], None)
+        return (None, key)
+
+    #--- Map misses: counted per key, no log per cell (see report_misses)
+    def count_miss(self, key):
+        self.misses += 1
+        self.missed[key] = self.missed.get(key, 0) + 1
+
+    def miss_value(self, cellvalue):
+        '''
+        Returns the value of a cell not found in the map table, None if
+        the cell should not generate triples
+        '''
+        if self.onmiss == KEEP:
+            return cellvalue #unmapped
+        if self.onmiss == DEFAULT:
+            return self.default
+        return None
+
+    #--------------to keep track of the ontology definitions required
+    def register(self, registry):
+        registry.register(CELL_TYPE,   self.celltypeURI,   self.celltype)
+        registry.register(COLUMN_TYPE, self.columntypeURI, self.columntype)
+
+    #--------------generate schema: once per grammar
+    def generate_schema(self, store, pkeytype):
+        pkeytypeURI = self.minter.uri(self.domain, pkeytype)
+
+        # 1. describe the celltype and the columntype
+        store.add((self.celltypeURI,   RDFS.label, Literal(self.celltype)))
+        store.add((self.columntypeURI, RDFS.label, Literal(self.columntype)))
+
+        # 2. domain/range of the columntype
+        if self.cellrole == SUBJECT:
+            store.add((self.columntypeURI, RDFS.domain, self.celltypeURI))
+            store.add((self.columntypeURI, RDFS.range,  pkeytypeURI))
+        else:
+            store.add((self.columntypeURI, RDFS.domain, pkeytypeURI))
+            store.add((self.columntypeURI, RDFS.range,  self.celltypeURI))
+
+    #--------------split modifier
+    def tokenize(self, cellvalue):
+        '''
+        Non empty tokens of a multi-valued cell, stripped
+        '''
+        return tuple(token.strip() for token in cellvalue.split(self.separator)
+                     if token.strip() != "")
+
+    #--------------memo of the terms
+    def terms(self, cellvalue):
+        '''
+        Terms of a cell value: (URI, label, miss key), the URI and the label
+        being None if the value is dropped. Memoised by the plan in self.memo:
+        the misses are counted by the plan, at each occurrence.
+        '''
+        (value, key) = self.alter_value(cellvalue)
+        if value is None:
+            return (None, None, key)
+        return (self.minter.uri(self.domain, value), self.minter.literal(value), key)
+
+    def check_memo(self):
+        '''
+        Disables the memo if its hit rate is below MEMORATE after MEMOPROBE
+        lookups. Returns True if the plan has to be compiled again.
+        '''
+        if self.memo is None or self.memooff:
+            return False
+        info = self.memo.cache_info()
+        lookups = info.hits + info.misses
+        if lookups < self.MEMOPROBE or info.hits >= self.MEMORATE * lookups:
+            return False
+        # the counts are kept for the reports, the values are released
+        self.memooff = True
+        self.memoinfo = info._replace(currsize=0)
+        self.memo.cache_clear()
+        self.memo = None
+        myprint("Memo of column " + self.columnname + " disabled: "
+                + str(info.hits) + " hits for " + str(lookups) + " lookups")
+        return True
+
+    def memo_info(self):
+        '''
+        cache_info of the memo, None if the column never had one
+        '''
+        return self.memoinfo if self.memo is None else self.memo.cache_info()
+
+    #--- the memo is not sent to the worker processes
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['memo'] = None
+        return state
+
+    #--------------execution plan
+    def plan(self, ns, n):
+        ns['T%d' % n] = self.celltypeURI
+        ns['C%d' % n] = self.columntypeURI
+        if self.memosize > 0 and not self.memooff:
+            body = self.plan_memo(ns, n)
+        else:
+            body = self.plan_inline(ns, n)
+        if not self.split:
+            return body
+        # one iteration per token, the tokens of a cell value being cached
+        ns['S%d' % n] = lru_cache(maxsize=self.TOKENS)(self.tokenize)
+        loop = ["for v in S%d(v):" % n]
+        if 'TOKENS' in ns:
+            loop.append("    TOKENS[%d] += 1" % n)
+        return loop + ["    " + line for line in body]
+
+    def plan_memo(self, ns, n):
+        # e = (URI, label, miss key), see terms
+        if self.memo is None:
+            self.memo = lru_cache(maxsize=self.memosize)(self.terms)
+        ns['M%d' % n] = self.memo
+        lines = ["e = M%d(v)" % n]
+        if self.altermode in MISS_MODES:
+            ns['R%d' % n] = self.count_miss
+            lines += ["if e[2] is not None:",
+                      "    R%d(e[2])" % n]
+        lines.append("u = e[0]")
+        triples = ["add((u, LABEL, e[1]))",
+                   "add((u, TYPE, T%d))" % n]
         if self.cellrole == SUBJECT:
-            store.add((cellvalueURI,  columntypeURI, pkeyvalueURI))
-            store.add((columntypeURI, RDFS.domain,   celltypeURI))
-            store.add((columntypeURI, RDFS.range,    pkeytypeURI))
+            triples.append("add((u, C%d, pk))" % n)
         else:
-            store.add((pkeyvalueURI,  columntypeURI, cellvalueURI))
-            store.add((columntypeURI, RDFS.domain,   pkeytypeURI))
-            store.add((columntypeURI, RDFS.range,    celltypeURI))
+            triples.append("add((pk, C%d, u))" % n)
+        if self.altermode in MISS_MODES and self.onmiss == DROP:
+            lines.append("if u is not None:")
+            triples = ["    " + line for line in triples]
+        return lines + triples
+
+    def plan_inline(self, ns, n):
+        lines = []
+        # 0. alterations: maps and regex keep their method (misses), others are inlined
+        if self.altermode in MISS_MODES:
+            ns['A%d' % n] = self.alter_cell_value
+            lines.append("v = A%d(v)" % n)
+            if self.onmiss == DROP:
+                lines.append("if v is not None:")
+        elif self.altermode == EXTRACT:
+            lines.append("v = v[%d:%d]" % (self.myinfchar, self.mymaxchar))
+        elif self.altermode == PREFIX:
+            ns['P%d' % n] = self.prefix
+            lines.append("v = v + P%d" % n)
+        triples = ["u = uri(D, v)",
+                   "add((u, LABEL, lit(v)))",
+                   "add((u, TYPE, T%d))" % n]
+        if self.cellrole == SUBJECT:
+            triples.append("add((u, C%d, pk))" % n)
+        else:
+            triples.append("add((pk, C%d, u))" % n)
+        if lines and lines[-1].startswith("if "):
+            triples = ["    " + line for line in triples]
+        return lines + triples
 
 
 #====================================================== LiteralColumn
 class LiteralColumn(Column):
-    def generate_triples(self, store, cellvalue, pkeyvalue, pkeytype):
-        # 1. create URIs
-        columntypeURI = URIRef(self.domain + format_URI(self.columntype))
-        pkeyvalueURI  = URIRef(self.domain + format_URI(pkeyvalue))
-        pkeytypeURI   = URIRef(self.domain + format_URI(pkeytype))
-
-        # 2. describe the columntype
-        store.add(( columntypeURI, RDFS.label, Literal(self.columntype)))
-        
-        # 3. to define in ontology 
-        to_define_in_ontology("Column type: " + columntypeURI.n3())
-        
-        # 4. create the real triple and domain/range
-        store.add((pkeyvalueURI,
-                   columntypeURI,
-                   Literal(cellvalue, datatype = self.celltype)))
-        store.add((columntypeURI, RDFS.domain, pkeytypeURI))
-        store.add((columntypeURI, RDFS.range,  RDFS.Literal))
+    def __init__(self, domain, name, lists, cellrole, celltype, columntype,
+                 pkey = False, minter = None):
+        super().__init__(domain, name, lists, cellrole, celltype, columntype, False, minter)
+        self.columntypeURI = self.minter.uri(self.domain, self.columntype)
+
+    #--------------to define in ontology
+    def register(self, registry):
+        registry.register(COLUMN_TYPE, self.columntypeURI, self.columntype)
+
+    #--------------generate schema: once per grammar
+    def generate_schema(self, store, pkeytype):
+        pkeytypeURI = self.minter.uri(self.domain, pkeytype)
+
+        # 1. describe the columntype
+        store.add(( self.columntypeURI, RDFS.label, Literal(self.columntype)))
+
+        # 2. domain/range of the columntype
+        store.add((self.columntypeURI, RDFS.domain, pkeytypeURI))
+        store.add((self.columntypeURI, RDFS.range,  RDFS.Literal))
+
+    #--------------execution plan
+    def plan(self, ns, n):
+        ns['C%d' % n] = self.columntypeURI
+        ns['DT%d' % n] = self.celltype
+        return ["add((pk, C%d, lit(v, DT%d)))" % (n, n)]
 
 
 #================================================= Grammar
 class Grammar():
+    MEMOCHECK = 10000 # rows between two checks of the memos of the columns
     # The Grammar constructor is a factory of column objects and list objects
-    def __init__(self, filename, domain, delim):
+    def __init__(self, filename, domain, delim, registry = None):
         self.filename = filename
         self.domain = domain
         self.delim = delim
@@ -357,6 +1111,19 @@ class Grammar():
         # record pkey = PKey()
         self.pkey = None
         self.pkeyindex = -1
+        # minimal number of fields of a row, known once the header is bound
+        self.rowlen = 0
+        # shared term factory of all the columns
+        self.minter = URIMinter()
+        # compiled execution plan, see compile_plan
+        self.plan = None
+        self.plansource = ""
+        self.plandump = None
+        # per column counters of the plan, None if not collected ('--report')
+        # self.counters = { "cells": [...], "empty": [...], "ns": [...] }
+        self.counters = None
+        # number of triples generated by a non empty cell, per column
+        self.pertriples = []
 
         #read sections
         if not os.path.isfile(filename):
@@ -371,6 +1138,19 @@ class Grammar():
                 for key in config[elem]:
                     mydict[key] = config[elem][key]
                 self.lists[elem] = mydict
+        # 1b. external map tables, 'map(all;@codes.csv)': paths relative to
+        # the grammar file, one MapTable per file shared by the columns
+        self.maptables = []
+        for elem in config.sections():
+            for name in re.findall(r";(@[^;,]+)\)", config[elem].get(CELLROLE, "")):
+                if name in self.lists:
+                    continue
+                path = os.path.join(os.path.dirname(filename), name[1:])
+                if not os.path.isfile(path):
+                    raise GrammarError("Map table '" + path + "' not found (grammar section "
+                                       + elem + ")")
+                self.lists[name] = MapTable(path, delim)
+                self.maptables.append(self.lists[name])
         # 2. then we get other sections that could need mapping lists
         # we play the role of a factory
         for elem in config.sections():
@@ -382,10 +1162,8 @@ class Grammar():
                 mydict[key] = config[elem][key]
             #pkey
             if CELLROLE not in mydict:
-                myprint("Error: '" + CELLROLE
-                      + "' is mandatory in grammar section "
-                      + elem + ". Exiting...")
-                exit()
+                raise GrammarError("'" + CELLROLE
+                                   + "' is mandatory in grammar section " + elem)
             # We do not record the Column and will not create a class
             if mydict[CELLROLE] == IGNORE:
                 continue
@@ -396,13 +1174,12 @@ class Grammar():
                                  PKEY,
                                  mydict[CELLTYPE],
                                  "",
-                                 True)
+                                 minter = self.minter)
                 self.columns[elem] = self.pkey
                 continue
             if not CELLTYPE in mydict:
-                myprint("Error: '" + CELLTYPE
-                      + "' is mandatory in grammar section. Exiting...")
-                exit()
+                raise GrammarError("'" + CELLTYPE
+                                   + "' is mandatory in grammar section " + elem)
             if mydict[CELLTYPE] in GRAMMAR_TYPES:
                 thetype = GRAMMAR_TYPES[mydict[CELLTYPE]]
                 self.columns[elem] = LiteralColumn(domain,
@@ -410,14 +1187,18 @@ class Grammar():
                                                    self.lists,
                                                    mydict[CELLROLE],
                                                    thetype,
-                                                   mydict[COLUMNTYPE])
+                                                   mydict[COLUMNTYPE],
+                                                   minter = self.minter)
             else:
                 self.columns[elem] = URIColumn(domain,
                                                elem,
                                                self.lists,
                                                mydict[CELLROLE],
                                                mydict[CELLTYPE],
-                                               mydict[COLUMNTYPE])
+                                               mydict[COLUMNTYPE],
+                                               minter = self.minter,
+                                               onmiss = mydict.get(ONMISS, KEEP),
+                                               memo = self.memo_size(mydict, elem))
                 
         # Error cases and reporting
         myprint("Found: "
@@ -426,85 +1207,1418 @@ class Grammar():
               + str(len(self.lists))
               + " lists")
         if self.pkey == None:
-            myprint("Error: pkey not found in grammar file. Exiting...")
-            exit()
+            raise GrammarError("pkey not found in grammar file " + filename)
+        # 3. types to define in the ontology, known at compile time
+        if registry is None:
+            registry = ONTOLOGY
+        for col in self.columns:
+            self.columns[col].register(registry)
+
+    def memo_size(self, mydict, elem):
+        try:
+            return int(mydict.get(MEMO, URIColumn.MEMOSIZE))
+        except ValueError:
+            raise GrammarError("'" + MEMO + "' should be an integer in grammar section "
+                               + elem)
+
+    #----------------------------------------------------generate_schema
+    def generate_schema(self, store):
+        '''
+        Schema triples (labels of the types, domain and range of the
+        column types) only depend on the grammar: they are generated once
+        here, and not for every cell by semantic_parser
+        '''
+        for col in self.columns:
+            self.columns[col].generate_schema(store, self.pkey.celltype)
+
+    #----------------------------------------------------bind_header
+    def bind_header(self, header):
+        '''
+        The grammar file section names should be included into the headers
+        note : it is not mandatory to take all the headers
+        '''
+        self.pkeyindex = -1
+        for col in self.columns:
+            # management of the ending $1 $2 etc.
+            # We only support 9 diff.treatments on the same cell value
+            # $1, ..., $9
+            colobj = self.columns[col]
+            if colobj.columnname[-2] == MULTITREATMENT: 
+                temp = colobj.columnname.split(MULTITREATMENT)[0]
+            else:
+                temp = colobj.columnname
+            if temp not in header:
+                raise GrammarError("grammar section name '" + colobj.columnname
+                                   + "' not found in CSV header")
+            i = 0
+            for headerelem in header:
+                if headerelem == temp:
+                    colobj.index = i
+                    if colobj.ispkey:
+                        self.pkeyindex = i
+                    break
+                i += 1
+        if self.pkeyindex == -1:
+            raise GrammarError("could not find pkey in CSV header")
+        # shorter rows cannot be converted, see convert_row_checked
+        self.rowlen = max(colobj.index for colobj in self.columns.values()) + 1
+        self.compile_plan()
+
+    #----------------------------------------------------compile_plan
+    def compile_plan(self, columns = None):
+        '''
+        Compiles the grammar, once the CSV indexes are known, into one flat
+        Python function plan(row, add): the columns are unrolled in grammar
+        order, the row independent URIs are constants of its namespace and
+        only the cell values are read in the loop. The source is kept in
+        self.plansource and written into self.plandump if set ('--plan').
+        columns: names of the columns to unroll, all by default; the plan
+        of some columns only is returned, not kept (benchmark.micro)
+        '''
+        ns = {'D': self.domain, 'LABEL': RDFS.label, 'TYPE': RDF.type,
+              'uri': self.minter.uri, 'lit': self.minter.literal}
+        code = ["def plan(row, add):",
+                "    pk = uri(D, row[%d])" % self.pkeyindex]
+        if columns is not None:
+            for n, col in enumerate(self.columns):
+                if col in columns:
+                    code.append("    v = row[%d]" % self.columns[col].index)
+                    code.append("    if v.strip() != \"\":")
+                    code += ["        " + line for line in self.columns[col].plan(ns, n)]
+            exec(compile("\n".join(code) + "\n", "<plan " + self.filename + ">", "exec"), ns)
+            return ns['plan']
+        if self.counters is not None:
+            nb = len(self.columns)
+            if not self.counters:
+                # kept when the plan is compiled again (check_memos)
+                self.counters = {"cells": [0] * nb, "empty": [0] * nb, "ns": [0] * nb,
+                                 "tokens": [0] * nb}
+            ns.update({'CELLS': self.counters["cells"], 'EMPTY': self.counters["empty"],
+                       'NS': self.counters["ns"], 'TOKENS': self.counters["tokens"],
+                       'clock': time.perf_counter_ns})
+            code.append("    t = clock()")
+        self.pertriples = []
+        n = 0
+        for col in self.columns:
+            colobj = self.columns[col]
+            lines = colobj.plan(ns, n)
+            self.pertriples.append(sum(1 for l in lines if l.lstrip().startswith("add(")))
+            code.append("    # column %d: '%s' (%s), csv index %d, %d triple(s) per %s"
+                        % (n, colobj.columnname, type(colobj).__name__,
+                           colobj.index, self.pertriples[n],
+                           "token" if getattr(colobj, "split", False) else "cell"))
+            code.append("    v = row[%d]" % colobj.index)
+            code.append("    if v.strip() != \"\":")
+            code += ["        " + line for line in lines]
+            if self.counters is not None:
+                code += ["        CELLS[%d] += 1" % n,
+                         "    else:",
+                         "        EMPTY[%d] += 1" % n,
+                         "    u = clock()",
+                         "    NS[%d] += u - t" % n,
+                         "    t = u"]
+            n += 1
+        self.plansource = "\n".join(code) + "\n"
+        exec(compile(self.plansource, "<plan " + self.filename + ">", "exec"), ns)
+        self.plan = ns['plan']
+        if self.plandump is not None:
+            with open(self.plandump, 'w', encoding='utf-8', newline='\n') as output:
+                output.write("# Execution plan of " + self.filename + "\n")
+                for name in sorted(ns):
+                    if name in ('plan', '__builtins__'):
+                        continue
+                    value = ns[name]
+                    if callable(value):
+                        value = value.__qualname__
+                    output.write("# " + name + " = " + repr(value) + "\n")
+                output.write(self.plansource)
+            myprint("Execution plan written into " + self.plandump)
+
+    #--- the compiled plan is not sent to the worker processes
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['plan'] = None
+        return state
+
+    #----------------------------------------------------convert_row
+    def convert_row(self, row, store):
+        # compiled by bind_header
+        self.plan(row, store.add)
+
+    def short_row(self, row, rownum, quarantine):
+        '''
+        True for the rows shorter than the bound columns: they are sent to
+        the quarantine, blank lines are skipped silently
+        '''
+        if len(row) >= self.rowlen:
+            return False
+        if len(row) != 0:
+            quarantine.add(rownum, "short row: " + str(len(row)) + " fields, "
+                           + str(self.rowlen) + " expected", row)
+        return True
+
+    def convert_row_checked(self, row, store, rownum, quarantine):
+        '''
+        convert_row isolating the bad rows: short rows and rows raising an
+        error are sent to the quarantine, the conversion goes on. The
+        triples of a row are only added to store once the whole row is
+        converted: a quarantined row adds nothing.
+        '''
+        if self.short_row(row, rownum, quarantine):
+            return
+        triples = []
+        try:
+            self.plan(row, triples.append)
+        except Exception as e:
+            quarantine.add(rownum, type(e).__name__ + ": " + str(e), row)
+            return
+        for triple in triples:
+            store.add(triple)
 
     #----------------------------------------------------semantic_parser
-    def semantic_parser(self, csvfile, store):
+    def semantic_parser(self, csvfile, store, progress = True,
+                        checkpoint = None, resume = None, report = None,
+                        quarantine = None):
+        '''
+        checkpoint: Checkpoint object saved every checkpoint.every rows
+        resume: checkpoint state to restart from (byte offset and row count)
+        report: RunReport sampling the throughput
+        quarantine: Quarantine of the bad rows (unlimited if None)
+        Returns the number of CSV rows read, header included.
+        '''
+        if quarantine is None:
+            quarantine = Quarantine(None, self.delim)
         count = 0
-        try:
-            reader = csv.reader(
-                open(csvfile, "r", encoding='utf-8', errors='ignore'),
-                delimiter=self.delim)
-            #--- begin tech
-            tim = Timer()
-            nblines = countLinesInCSVFile(csvfile)
+        if resume is None:
+            reader = CSVRecords(csvfile, self.delim)
+        else:
+            self.bind_header(next(iter(CSVRecords(csvfile, self.delim))))
+            reader = CSVRecords(csvfile, self.delim, resume["offset"])
+            count = resume["rows"]
+            myprint("Resuming at row " + str(count))
+        #--- begin tech
+        tim = Timer()
+        if progress:
+            with profile_phase("count"):
+                nblines = countLinesInCSVFile(csvfile)
             bar = progressbar2.ProgressBar(max_value=nblines)
-            #--- end tech
-            header = None
-            pkeyindex = -1
-            for row in reader:
+        else:
+            bar = progressbar2.NullBar()
+        #--- end tech
+        every = memory_every()
+        with profile_phase("rows"):
+            for row in reader.tolerant():
                 bar.update(count)
                 # 1. Management of header
-                if count == 0:
-                    header = row
-                    # 1. the grammar file section names should be included into the headers
-                    # note : it is not mandatory to take all the headers
-                    for col in self.columns:
-                        # management of the ending $1 $2 etc.
-                        # We only support 9 diff.treatments on the same cell value
-                        # $1, ..., $9
-                        colobj = self.columns[col]
-                        if colobj.columnname[-2] == MULTITREATMENT: 
-                            temp = colobj.columnname.split(MULTITREATMENT)[0]
-                        else:
-                            temp = colobj.columnname
-                        if temp not in header:
-                            myprint("Error: grammar section name '"
-                                  + colobj.columnname
-                                  + "' not found in CSV file. Exiting...")
-                            exit()
-                        i = 0
-                        for headerelem in header:
-                            if headerelem == temp:
-                                colobj.index = i
-                                if colobj.ispkey:
-                                    pkeyindex = i
-                                break
-                            i += 1
-                    if pkeyindex == -1:
-                        myprint("Error: could not find pkey in CSV header. Exiting...")
-                        exit()
-                    # increment CSV line number
-                    count +=1
+                if row is None:
+                    # malformed record
+                    if count == 0:
+                        raise GrammarError("CSV header of " + csvfile + " not readable")
+                    quarantine.add(count, "csv error: " + str(reader.error), [])
+                elif count == 0:
+                    self.bind_header(row)
                 else:
-                    pkeyvalue = row[pkeyindex]
-                    # general case: standard row
-                    for col in self.columns:
-                        colobj = self.columns[col]
-                        cellvalue = row[colobj.index]
-                        if cellvalue.strip() == "":
-                            continue
-                        else:
-                            colobj.generate_triples(store,
-                                                    cellvalue,
-                                                    pkeyvalue,
-                                                    self.pkey.celltype)
-                    count +=1
-            tim.stop()
-        except csv.Error as e:
-            myprint("Error caught in loading csv file: " + f)
-            myprint(e)
-            sys.exit(1)
+                    self.convert_row_checked(row, store, count, quarantine)
+                # increment CSV line number
+                count +=1
+                if checkpoint is not None and count % checkpoint.every == 0:
+                    checkpoint.save(reader.offset, count, store, self.missed_values(),
+                                    quarantine)
+                if report is not None and count % report.EVERY == 0:
+                    report.tick(count)
+                if count % self.MEMOCHECK == 0:
+                    self.check_memos()
+                if every and count % every == 0:
+                    memory_snapshot("rows " + str(count), store_size(store))
+        tim.stop()
         myprint("Information: " + str(count) + " csv row converted")
+        self.report_caches()
+        return count
+
+    #----------------------------------------------------caches
+    def check_memos(self):
+        '''
+        Called every MEMOCHECK rows: the plan is compiled again without
+        the memos disabled by their column
+        '''
+        disabled = [colobj.check_memo() for colobj in self.columns.values()
+                    if isinstance(colobj, URIColumn)]
+        if any(disabled):
+            self.compile_plan()
+
+    def report_caches(self):
+        self.minter.report()
+        for table in self.maptables:
+            table.report()
+        for colobj in self.columns.values():
+            if isinstance(colobj, URIColumn) and colobj.memo_info() is not None:
+                info = colobj.memo_info()
+                myprint("Memo of column " + colobj.columnname + ": "
+                        + str(info.hits) + " hits, " + str(info.misses) + " misses, "
+                        + str(info.currsize) + " values"
+                        + (" (disabled)" if colobj.memooff else ""))
+
+    #----------------------------------------------------convert_chunk
+    def convert_chunk(self, csvfile, header, start, end, store, first = 1,
+                      quarantine = None):
+        '''
+        Conversion of the records in the byte range [start, end) of the CSV
+        file (see split_csv), first being the number of its first row.
+        Returns the number of rows converted.
+        '''
+        if quarantine is None:
+            quarantine = Quarantine(None, self.delim)
+        count = 0
+        self.bind_header(header)
+        reader = CSVRecords(csvfile, self.delim, start, end)
+        every = memory_every()
+        for row in reader.tolerant():
+            if row is None:
+                quarantine.add(first + count, "csv error: " + str(reader.error), [])
+            else:
+                self.convert_row_checked(row, store, first + count, quarantine)
+            count += 1
+            if count % self.MEMOCHECK == 0:
+                self.check_memos()
+            if every and count % every == 0:
+                memory_snapshot("rows " + str(first + count), store_size(store))
+        self.report_caches()
+        return count
+
+    #----------------------------------------------------map misses
+    def missed_values(self):
+        '''
+        Returns { column name: { map key: number of cells } }
+        '''
+        return {colobj.columnname: colobj.missed for colobj in self.columns.values()
+                if isinstance(colobj, URIColumn) and colobj.missed}
+
+    def merge_missed(self, missed):
+        # used to gather the misses of the worker processes (--split)
+        # and of the run before a checkpoint (--resume)
+        for name, keys in missed.items():
+            colobj = self.columns[name]
+            for key, nb in keys.items():
+                colobj.missed[key] = colobj.missed.get(key, 0) + nb
+                colobj.misses += nb
+
+    def report_misses(self, filename):
+        '''
+        One warning per column and the unmapped values, most frequent
+        first, in the CSV file filename. The 'entry' field can be pasted
+        into the [*list*] section of the grammar (or into the map table).
+        '''
+        rows = []
+        for colobj in self.columns.values():
+            if not isinstance(colobj, URIColumn) or not colobj.missed:
+                continue
+            myprint("Warning: " + str(colobj.misses) + " cell(s) of column "
+                    + colobj.columnname
+                    + (" not matched by " if colobj.altermode == REGEX else " not in maptable ")
+                    + colobj.mapname
+                    + " (" + str(len(colobj.missed)) + " distinct values, "
+                    + ("kept" if colobj.onmiss == KEEP else
+                       "dropped" if colobj.onmiss == DROP else
+                       "replaced by '" + colobj.default + "'") + ")", WARNING)
+            for key, nb in colobj.missed.items():
+                rows.append((colobj.mapname, key, nb, colobj.columnname))
+        if len(rows) == 0:
+            if os.path.isfile(filename):
+                os.remove(filename)
+            return
+        rows.sort(key=lambda row: (-row[2], row[0], row[1]))
+        with open(filename, 'w', encoding='utf-8', newline='') as output:
+            writer = csv.writer(output, delimiter=self.delim)
+            writer.writerow(["list", "value", "count", "column", "entry"])
+            for (mapname, key, nb, column) in rows:
+                # external tables are CSV files: the value column is to be added
+                writer.writerow([mapname, key, nb, column,
+                                 key if mapname.startswith('@') else key + " = "])
+        myprint("Unmapped values written into " + filename)
+
+
+#================================================= ColumnarEngine
+class ColumnarEngine():
+    '''
+    Alternative to semantic_parser: the CSV file is read by batches of
+    about CELLS cells with the C parser of pandas, the alterations (map,
+    extract, prefix, regex), the URI sanitisation and the N-Triples
+    escaping are whole column string operations. The lines of the columns
+    are interleaved row by row so the output is the same as the one of a
+    '--stream' run.
+    '''
+    CELLS = 200000  # cells per batch
+    MINBATCH = 1000 # rows per batch, at least
+    LOG = 100000    # rows between two progress messages
+    def __init__(self, gram):
+        load_pandas()
+        self.gram = gram
+        self.label = nt_term(RDFS.label)
+        self.type = nt_term(RDF.type)
+
+    #--- column operations
+    def distinct(self, col, operation):
+        '''
+        The column operation run on the distinct values of col only
+        '''
+        codes, uniques = pandas.factorize(col, use_na_sentinel=False)
+        return operation(pandas.Series(uniques, dtype=object)).take(codes).set_axis(col.index)
+    def escape(self, col):
+        return col.str.translate(NT_ESCAPE)
+    def uri(self, col):
+        return '<' + self.gram.domain + col.str.translate(URI_TABLE) + '>'
+    def alter(self, colobj, col):
+        '''
+        Returns the altered column, the cells dropped by the miss policy
+        being None
+        '''
+        if colobj.altermode == NONE:
+            return col
+        if colobj.altermode in MATCH_MODES:
+            # regex and prefix lookups run once per distinct value of the batch
+            codes, uniques = pandas.factorize(col)
+            results = [colobj.match_value(v) for v in uniques]
+            mapped = pandas.Series([r[0] for r in results], dtype=object) \
+                           .take(codes).set_axis(col.index)
+            key = pandas.Series([r[1] for r in results], dtype=object) \
+                        .take(codes).set_axis(col.index)
+            missed = key.notna() & (col.str.strip() != "")
+        elif colobj.altermode in (MAP_ALL, MAP_PART):
+            key = col.str.lower() if colobj.altermode == MAP_ALL \
+                else col.str.slice(colobj.myinfchar, colobj.mymaxchar).str.lower()
+            if isinstance(colobj.maptable, MapTable):
+                mapped = key.map(colobj.maptable.get)
+            else:
+                mapped = key.map(colobj.maptable)
+            missed = mapped.isna() & (col.str.strip() != "")
+        if colobj.altermode in MISS_MODES:
+            for value, nb in key[missed].value_counts().items():
+                colobj.missed[value] = colobj.missed.get(value, 0) + int(nb)
+                colobj.misses += int(nb)
+            newcol = col.where(mapped.isna(), mapped)
+            if colobj.onmiss == KEEP:
+                return newcol
+            if colobj.onmiss == DEFAULT:
+                return newcol.where(~missed, colobj.default)
+            return newcol.astype(object).where(~missed, None)
+        if colobj.altermode == EXTRACT:
+            return col.str.slice(colobj.myinfchar, colobj.mymaxchar)
+        if colobj.altermode == PREFIX:
+            return col + colobj.prefix
+    def literal(self, colobj, col):
+        if colobj.celltype == XSD.string:
+            datatype = '"^^<' + colobj.celltype + '>'
+            return self.distinct(col, lambda values: '"' + self.escape(values) + datatype)
+        # other datatypes may be normalised by rdflib: done on distinct values
+        codes, uniques = pandas.factorize(col)
+        terms = [nt_term(colobj.minter.literal(v, colobj.celltype)) for v in uniques]
+        return pandas.Series(terms, dtype=object).take(codes).set_axis(col.index)
+
+    #--- N-Triples lines of one column for a batch
+    def column_lines(self, colobj, col, pkURI):
+        if getattr(colobj, "split", False):
+            # one row per token, the lines of the tokens of a cell joined back
+            tokens = col.map(colobj.tokenize).explode().dropna().astype(col.dtype)
+            lines = self.column_lines_value(colobj, tokens, pkURI.loc[tokens.index])
+            return lines.groupby(level=0).agg(''.join).reindex(col.index, fill_value="")
+        return self.column_lines_value(colobj, col, pkURI)
+    def column_lines_value(self, colobj, col, pkURI):
+        if isinstance(colobj, PKey):
+            cellURI = self.uri(col)
+            return (cellURI + (' ' + self.label + ' "') + self.escape(col)
+                    + ('" .\n') + cellURI
+                    + (' ' + self.type + ' ' + nt_term(colobj.celltypeURI) + ' .\n'))
+        if isinstance(colobj, LiteralColumn):
+            return (pkURI + (' ' + nt_term(colobj.columntypeURI) + ' ')
+                    + self.literal(colobj, col) + ' .\n')
+        newcol = self.alter(colobj, col)
+        if colobj.onmiss == DROP and colobj.altermode in MISS_MODES:
+            lines = self.column_lines_uri(colobj, newcol.fillna(""), pkURI)
+            return lines.where(newcol.notna(), "")
+        return self.column_lines_uri(colobj, newcol, pkURI)
+    def column_lines_uri(self, colobj, newcol, pkURI):
+        # URI, label and type of the distinct values of the column
+        codes, uniques = pandas.factorize(newcol, use_na_sentinel=False)
+        uniques = pandas.Series(uniques, dtype=object)
+        uris = self.uri(uniques)
+        terms = (uris + (' ' + self.label + ' "') + self.escape(uniques) + '" .\n' + uris
+                 + (' ' + self.type + ' ' + nt_term(colobj.celltypeURI) + ' .\n'))
+        cellURI = uris.take(codes).set_axis(newcol.index)
+        lines = terms.take(codes).set_axis(newcol.index)
+        predicate = ' ' + nt_term(colobj.columntypeURI) + ' '
+        if colobj.cellrole == SUBJECT:
+            return lines + cellURI + predicate + pkURI + ' .\n'
+        return lines + pkURI + predicate + cellURI + ' .\n'
+
+    #--- conversion
+    def good_rows(self, batch, records, reader, quarantine, first):
+        '''
+        The pandas C parser pads the short rows with "": the records of the
+        batch are also read by CSVRecords, as by semantic_parser. Returns
+        the mask of the rows to convert; the short rows and the malformed
+        records are sent to the quarantine with the same row numbers (first
+        being the number of the first row of the batch), the blank lines
+        are skipped.
+        '''
+        good = []
+        for rownum, row in enumerate(islice(records, len(batch)), first):
+            if row is None:
+                quarantine.add(rownum, "csv error: " + str(reader.error), [])
+                good.append(False)
+            else:
+                good.append(not self.gram.short_row(row, rownum, quarantine))
+        if len(good) != len(batch):
+            raise GrammarError("Columnar engine: the records of pandas and csv differ"
+                               " at row " + str(first + len(good))
+                               + ", use '--engine " + ROWS + "'")
+        return good
+
+    def convert(self, csvfile, store, quarantine = None):
+        '''
+        Writes the instance triples into the NTriplesStore store, batch by
+        batch, row by row. The fields beyond the header are ignored, the
+        short rows are sent to quarantine (a Quarantine, unlimited if None),
+        the blank lines are skipped.
+        Returns the number of rows converted.
+        '''
+        gram = self.gram
+        if quarantine is None:
+            quarantine = Quarantine(None, gram.delim)
+        reader = CSVRecords(csvfile, gram.delim)
+        records = reader.tolerant()
+        header = next(records)
+        gram.bind_header(header)
+        count = 0
+        first = 1
+        # about CELLS cells per batch, whatever the number of columns
+        batches = pandas.read_csv(csvfile, sep=gram.delim, header=None, skiprows=1,
+                                  names=range(len(header)), usecols=range(len(header)),
+                                  dtype=object, na_filter=False, skip_blank_lines=False,
+                                  encoding='utf-8', encoding_errors='ignore',
+                                  chunksize=max(self.MINBATCH, self.CELLS // len(header)))
+        indexes = sorted(set(colobj.index for colobj in gram.columns.values()))
+        for batch in batches:
+            good = self.good_rows(batch, records, reader, quarantine, first)
+            first += len(batch)
+            data = batch if all(good) else batch[good]
+            # new lines in quoted fields: '\r\n' is read as '\n' (see CSVRecords)
+            for i in indexes:
+                data[i] = self.distinct(data[i], lambda values:
+                                        values.str.replace('\r\n', '\n', regex=False))
+            pkURI = self.uri(data[gram.pkeyindex])
+            # the same CSV column may be bound to several grammar columns
+            nonempty = {i: self.distinct(data[i], lambda values: values.str.strip() != "")
+                        for i in indexes}
+            columns = []
+            for col in gram.columns:
+                colobj = gram.columns[col]
+                lines = self.column_lines(colobj, data[colobj.index], pkURI)
+                lines = lines.where(nonempty[colobj.index], "").tolist()
+                store.count += ''.join(lines).count('\n')
+                columns.append(lines)
+            # the lines of the columns interleaved row by row
+            store.output.writelines(map(''.join, zip(*columns)))
+            count += len(data)
+            if count // self.LOG != (count - len(data)) // self.LOG:
+                myprint("Columnar engine: " + str(count) + " rows converted")
+        if next(records, None) is not None:
+            raise GrammarError("Columnar engine: the records of pandas and csv differ"
+                               " at row " + str(first) + ", use '--engine " + ROWS + "'")
+        return count
+
+
+#================================================= RunReport
+class RunReport():
+    '''
+    Machine readable report of the conversion of a source ('--report'):
+    per column counters of the grammar (cells seen, empty cells, triples,
+    alteration mode, map hits and misses, time) and the throughput sampled
+    every interval seconds, written into [SOURCE]-report.json.
+    The clock is only read every EVERY rows.
+    '''
+    EVERY = 1000
+    def __init__(self, source, interval):
+        self.source = source
+        self.interval = interval
+        self.filename = source.name + "-report.json"
+        self.start = time.time()
+        self.last = (self.start, 0)
+        # self.samples = [ { seconds, rows, rows_per_s }, ... ]
+        self.samples = []
+    def tick(self, rows):
+        now = time.time()
+        if now - self.last[0] < self.interval:
+            return
+        self.samples.append({"seconds": round(now - self.start, 3),
+                             "rows": rows,
+                             "rows_per_s": round((rows - self.last[1])
+                                                 / (now - self.last[0]), 1)})
+        self.last = (now, rows)
+    def columns(self, gram):
+        columns = []
+        n = 0
+        for col in gram.columns:
+            colobj = gram.columns[col]
+            cells = gram.counters["cells"][n]
+            # values altered and converted: the tokens of the split columns
+            split = getattr(colobj, "split", False)
+            values = gram.counters["tokens"][n] if split else cells
+            column = {"column": colobj.columnname,
+                      "kind": type(colobj).__name__,
+                      "mode": ALTER_NAMES[getattr(colobj, "altermode", NONE)],
+                      "cells": cells,
+                      "empty": gram.counters["empty"][n],
+                      "triples": (values - (colobj.misses if getattr(colobj, "onmiss", KEEP)
+                                            == DROP else 0)) * gram.pertriples[n],
+                      "seconds": round(gram.counters["ns"][n] / 1e9, 6)}
+            if split:
+                column["tokens"] = values
+            if isinstance(colobj, URIColumn) and colobj.memo_info() is not None:
+                info = colobj.memo_info()
+                column["memo_hits"] = info.hits
+                column["memo_misses"] = info.misses
+                column["memo_disabled"] = colobj.memooff
+            if getattr(colobj, "altermode", NONE) in MISS_MODES:
+                column["map_hits"] = values - colobj.misses
+                column["map_misses"] = colobj.misses
+            columns.append(column)
+            n += 1
+        return columns
+    def write(self, gram, rows, triples):
+        duration = time.time() - self.start
+        report = {"source": self.source.name,
+                  "file": self.source.file,
+                  "grammar": self.source.semanticfile,
+                  "rows": rows,
+                  "triples": triples,
+                  "seconds": round(duration, 3),
+                  "rows_per_s": round(rows / duration, 1) if duration > 0 else None,
+                  "throughput": self.samples,
+                  "columns": self.columns(gram)}
+        with open(self.filename, 'w', encoding='utf-8') as output:
+            json.dump(report, output, indent=2)
+        myprint("Run report written into " + self.filename)
+
+
+PROMETHEUS = [
+    # (metric, column key, help)
+    ("csv2rdf_column_cells_total", "cells", "Non empty cells converted"),
+    ("csv2rdf_column_empty_cells_total", "empty", "Empty cells skipped"),
+    ("csv2rdf_column_triples_total", "triples", "Triples generated"),
+    ("csv2rdf_column_map_hits_total", "map_hits", "Cell values found in the map table"),
+    ("csv2rdf_column_map_misses_total", "map_misses", "Cell values not in the map table"),
+    ("csv2rdf_column_seconds_total", "seconds", "Time spent in the column"),
+]
+
+def prom_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def write_prometheus(filename, sources):
+    '''
+    Prometheus textfile (node exporter textfile collector) built from the
+    run reports of the sources, written atomically
+    '''
+    reports = []
+    for source in sources:
+        if os.path.isfile(source.name + "-report.json"):
+            with open(source.name + "-report.json", encoding='utf-8') as f:
+                reports.append(json.load(f))
+    lines = []
+    for (metric, key, help) in [("csv2rdf_rows_total", "rows", "CSV rows converted"),
+                                ("csv2rdf_triples_total", "triples", "Triples written"),
+                                ("csv2rdf_duration_seconds", "seconds", "Conversion duration")]:
+        lines.append("# HELP " + metric + " " + help)
+        lines.append("# TYPE " + metric + (" gauge" if key == "seconds" else " counter"))
+        for report in reports:
+            if report[key] is not None:
+                lines.append('%s{source="%s"} %s' % (metric, prom_label(report["source"]),
+                                                     report[key]))
+    for (metric, key, help) in PROMETHEUS:
+        lines.append("# HELP " + metric + " " + help)
+        lines.append("# TYPE " + metric + " counter")
+        for report in reports:
+            for column in report["columns"]:
+                if key in column:
+                    lines.append('%s{source="%s",column="%s"} %s'
+                                 % (metric, prom_label(report["source"]),
+                                    prom_label(column["column"]), column[key]))
+    temp = filename + ".tmp"
+    with open(temp, 'w', encoding='utf-8', newline='\n') as output:
+        output.write("\n".join(lines) + "\n")
+    os.replace(temp, filename)
+    myprint("Prometheus metrics written into " + filename)
+
+
+#================================================= Quarantine
+class Quarantine():
+    '''
+    Rows that could not be converted, written into [SOURCE]-quarantine.csv
+    with their row number (the header being row 0), the reason and the raw
+    fields. The file is only created with the first bad row; with a None
+    filename, the bad rows are only counted and logged.
+    budget: maximal number of bad rows ('--max-errors'), None if unlimited
+    resume: (size, count) saved by a checkpoint ('--resume'): the file is
+    truncated to size bytes and count bad rows are already in the budget
+    '''
+    MAXLOG = 10 # bad rows logged one by one
+    HEADER = ["row", "reason", "fields"]
+    def __init__(self, filename, delim, budget = None, append = False, resume = None):
+        self.filename = filename
+        self.delim = delim
+        self.budget = budget
+        self.append = append
+        self.count = 0
+        self.output = None
+        self.writer = None
+        if filename is None or not os.path.isfile(filename):
+            pass
+        elif not append or (resume is not None and resume[0] == 0):
+            os.remove(filename)
+        elif resume is not None:
+            # the bad rows after the checkpoint are quarantined again
+            os.truncate(filename, resume[0])
+        if resume is not None:
+            self.count = resume[1]
+    def write(self, record):
+        if self.filename is None:
+            return
+        if self.writer is None:
+            new = not (self.append and os.path.isfile(self.filename))
+            self.output = open(self.filename, 'a' if self.append else 'w',
+                               encoding='utf-8', newline='')
+            self.writer = csv.writer(self.output, delimiter=self.delim)
+            if new:
+                self.writer.writerow(self.HEADER)
+        self.writer.writerow(record)
+    def check(self):
+        if self.budget is not None and self.count > self.budget:
+            raise ErrorBudgetExceeded(str(self.count) + " rows quarantined, the budget is "
+                                      + str(self.budget))
+    def add(self, rownum, reason, row):
+        self.count += 1
+        if self.count <= self.MAXLOG:
+            myprint("Warning: row " + str(rownum) + " quarantined: " + reason, WARNING)
+        self.write([rownum, reason] + row)
+        self.check()
+    def merge(self, filename):
+        # used to gather the quarantines of the worker processes (--split)
+        if not os.path.isfile(filename):
+            return
+        with open(filename, 'r', encoding='utf-8', newline='') as part:
+            reader = csv.reader(part, delimiter=self.delim)
+            next(reader, None)
+            for record in reader:
+                self.count += 1
+                self.write(record)
+        os.remove(filename)
+    def flush(self):
+        '''
+        Returns (size in bytes of the file written so far, count)
+        '''
+        if self.output is not None:
+            self.output.flush()
+            os.fsync(self.output.fileno())
+            return (os.fstat(self.output.fileno()).st_size, self.count)
+        if self.filename is not None and os.path.isfile(self.filename):
+            return (os.path.getsize(self.filename), self.count)
+        return (0, self.count)
+    def close(self):
+        if self.output is not None:
+            self.output.close()
+            self.output = None
+            self.writer = None
+        if self.count != 0:
+            myprint("Warning: " + str(self.count) + " row(s) quarantined"
+                    + ("" if self.filename is None else " into " + self.filename),
+                    WARNING)
+
+
+#================================================= Checkpoint
+class Checkpoint():
+    '''
+    Periodic state of a streaming conversion, in [SOURCE].checkpoint:
+    CSV byte offset and row count, with the size of the flushed output,
+    the size and count of the flushed quarantine and the map misses so far
+    (reported at the end of the resumed run)
+    '''
+    def __init__(self, source, every):
+        self.source = source
+        self.every = every
+        self.filename = source.name + ".checkpoint"
+    def save(self, offset, rows, store, missed, quarantine):
+        state = {"source": self.source.name,
+                 "file": self.source.file,
+                 "offset": offset,
+                 "rows": rows,
+                 "output": store.name,
+                 "outputsize": store.flush(),
+                 "triples": store.count,
+                 "quarantine": quarantine.flush(),
+                 "missed": missed}
+        with open(self.filename + ".tmp", 'w', encoding='utf-8') as f:
+            json.dump(state, f)
+        os.replace(self.filename + ".tmp", self.filename)
+    def load(self):
+        if not os.path.isfile(self.filename):
+            return None
+        with open(self.filename, 'r', encoding='utf-8') as f:
+            state = json.load(f)
+        if state["file"] != self.source.file or not os.path.isfile(state["output"]):
+            myprint("Warning: checkpoint " + self.filename
+                    + " does not match the source, ignored", WARNING)
+            return None
+        return state
+    def remove(self):
+        if os.path.isfile(self.filename):
+            os.remove(self.filename)
+
+
+#================================================= Incremental conversion
+class RowState():
+    '''
+    State kept between two runs of the same source, in a SQLite file:
+    - one fingerprint per pkey value, computed on the cells of the columns
+      used by the grammar, for all the rows sharing this pkey value,
+    - the rows themselves, to be able to regenerate the triples to remove,
+    - refs: for the label and type triples (N-Triples lines), that all the
+      pkey groups using the same cell value generate, the number of groups
+      generating them,
+    - the fingerprint of the grammar and the version of the state.
+    The rows of the changed pkeys are staged in a temporary table. The
+    changes are committed at the end of the run (commit).
+    '''
+    VERSION = "2"
+    BATCH = 100000 # distinct shared triples counted at once
+    def __init__(self, filename):
+        self.filename = filename
+        self.isnew = not os.path.isfile(filename)
+        self.db = sqlite3.connect(filename)
+        self.db.execute("CREATE TABLE IF NOT EXISTS meta "
+                        "(key TEXT PRIMARY KEY, value TEXT)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS rows "
+                        "(pkey TEXT PRIMARY KEY, fp BLOB, rows TEXT)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS refs "
+                        "(line TEXT PRIMARY KEY, n INTEGER) WITHOUT ROWID")
+        self.db.execute("CREATE TEMP TABLE staged (pkey TEXT, row TEXT)")
+        self.db.execute("CREATE INDEX temp.staged_pkey ON staged (pkey)")
+        self.db.execute("CREATE TEMP TABLE counts "
+                        "(line TEXT PRIMARY KEY, d INTEGER) WITHOUT ROWID")
+    def get_meta(self, key):
+        res = self.db.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return None if res is None else res[0]
+    def fingerprints(self):
+        # cursor on (pkey, fingerprint)
+        return self.db.execute("SELECT pkey, fp FROM rows")
+    def rows(self, pkey):
+        res = self.db.execute("SELECT rows FROM rows WHERE pkey = ?", (pkey,)).fetchone()
+        return [] if res is None else json.loads(res[0])
+    #--- rows of the run
+    def stage(self, rows):
+        # rows: iterator of (pkey, row)
+        self.db.executemany("INSERT INTO staged VALUES (?, ?)",
+                            ((pkey, json.dumps(row)) for (pkey, row) in rows))
+    def staged(self, pkey):
+        return [json.loads(row) for (row,) in
+                self.db.execute("SELECT row FROM staged WHERE pkey = ? ORDER BY rowid",
+                                (pkey,))]
+    def put(self, pkey, fp, rows):
+        self.db.execute("INSERT OR REPLACE INTO rows VALUES (?, ?, ?)",
+                        (pkey, fp, json.dumps(rows)))
+    def delete(self, pkey):
+        self.db.execute("DELETE FROM rows WHERE pkey = ?", (pkey,))
+    #--- reference counts of the shared triples
+    def count(self, deltas):
+        '''
+        Applies deltas = { N-Triples line: change of its count } and
+        returns (lines now generated by a group, lines no longer generated)
+        '''
+        self.db.execute("DELETE FROM counts")
+        self.db.executemany("INSERT INTO counts VALUES (?, ?)", deltas.items())
+        adds = []
+        removes = []
+        for (line, d, n) in self.db.execute(
+                "SELECT c.line, c.d, IFNULL(r.n, 0) FROM counts c "
+                "LEFT JOIN refs r ON r.line = c.line"):
+            if n <= 0 < n + d:
+                adds.append(line)
+            elif n > 0 >= n + d:
+                removes.append(line)
+        self.db.execute("INSERT INTO refs SELECT line, d FROM counts WHERE true "
+                        "ON CONFLICT (line) DO UPDATE SET n = n + excluded.n")
+        self.db.execute("DELETE FROM refs WHERE n <= 0 "
+                        "AND line IN (SELECT line FROM counts)")
+        return (adds, removes)
+    def commit(self, meta):
+        self.db.executemany("INSERT OR REPLACE INTO meta VALUES (?, ?)", meta.items())
+        self.db.commit()
+    def close(self):
+        self.db.close()
+
+
+def grammar_fingerprint(source, maptables = ()):
+    h = hashlib.blake2b(digest_size=16)
+    with open(source.semanticfile, 'rb') as f:
+        h.update(f.read())
+    h.update(source.domain.encode('utf-8'))
+    # the external map tables are part of the grammar
+    for table in maptables:
+        h.update(table.stamp().encode('utf-8'))
+    return h.hexdigest()
+
+
+def nt_line(triple):
+    (s, p, o) = triple
+    return '%s %s %s .\n' % (nt_term(s), nt_term(p), nt_term(o))
+
+
+class DeltaWriter():
+    '''
+    Delta written on the fly into two N-Triples files, [SOURCE]-delta-add.nt
+    and [SOURCE]-delta-remove.nt, or into a SPARQL Update script
+    [SOURCE]-delta.ru assembled from them by close
+    '''
+    def __init__(self, name, sparql):
+        self.name = name
+        self.sparql = sparql
+        self.adds = NTriplesStore(name + "-delta-add.nt")
+        self.removes = NTriplesStore(name + "-delta-remove.nt")
+    def write(self, store, lines):
+        store.write(''.join(lines))
+        store.count += len(lines)
+    def close(self):
+        self.adds.dump()
+        self.removes.dump()
+        if not self.sparql:
+            myprint("Delta written to " + self.adds.name + " and " + self.removes.name)
+            return
+        with open(self.name + "-delta.ru", 'wb') as output:
+            output.write(b"DELETE DATA {\n")
+            for (store, end) in ((self.removes, b"} ;\nINSERT DATA {\n"),
+                                 (self.adds, b"}\n")):
+                with open(store.name, 'rb') as input:
+                    shutil.copyfileobj(input, output, 1024 * 1024)
+                os.remove(store.name)
+                output.write(end)
+        myprint("Delta written to " + self.name + "-delta.ru")
+
+
+def convert_source_incremental(source, settings, registry = None):
+    '''
+    Only the rows whose pkey group was added, changed or deleted since the
+    previous run are converted. For each of these pkey groups, the triples
+    of its old rows (from the state) and of its new rows are compared:
+    the label and type triples, shared by the groups using the same cell
+    value, are only removed when no group generates them any more (see
+    RowState.count). The rows and the triples are streamed: the memory
+    holds one fingerprint per pkey and the triples of one pkey group.
+    '''
+    gram = Grammar(source.semanticfile, source.domain, source.delim, registry)
+    state = RowState(source.name + ".state.sqlite")
+    gramfp = grammar_fingerprint(source, gram.maptables)
+    if not state.isnew and (state.get_meta("grammar") != gramfp
+                            or state.get_meta("version") != RowState.VERSION):
+        myprint("Error: grammar or state format changed since the last incremental run of "
+                + source.name + ", a full conversion is required: remove "
+                + state.filename, ERROR)
+        state.close()
+        return
+    tim = Timer()
+    # 1. fingerprints of the pkey groups, on the cells used by the grammar
+    reader = CSVRecords(source.file, source.delim)
+    records = reader.tolerant()
+    gram.bind_header(next(records))
+    indexes = sorted(set(gram.columns[col].index for col in gram.columns))
+    # fps = { pkey: digest of its rows, chained in row order }
+    fps = {}
+    quarantine = Quarantine(source.name + "-quarantine.csv", source.delim,
+                            settings.maxerrors)
+    try:
+        for count, row in enumerate(records, 1):
+            if row is None:
+                quarantine.add(count, "csv error: " + str(reader.error), [])
+                continue
+            if gram.short_row(row, count, quarantine):
+                continue
+            pkey = row[gram.pkeyindex]
+            data = '\x1f'.join([row[i] for i in indexes]).encode('utf-8') + b'\x1e'
+            fps[pkey] = hashlib.blake2b(fps.get(pkey, b'') + data, digest_size=16).digest()
+    finally:
+        quarantine.close()
+    # 2. only the added and changed pkeys are kept in fps
+    total = len(fps)
+    added = total
+    changed = 0
+    deleted = []
+    for (pkey, fp) in state.fingerprints():
+        if pkey not in fps:
+            deleted.append(pkey)
+            continue
+        added -= 1
+        if fps[pkey] == fp:
+            del fps[pkey]
+        else:
+            changed += 1
+    myprint("Incremental: " + str(total) + " pkeys, " + str(added) + " added, "
+            + str(changed) + " changed, " + str(len(deleted)) + " deleted")
+    # 3. rows of the added and changed pkeys
+    if len(fps) != 0:
+        records = CSVRecords(source.file, source.delim).tolerant()
+        next(records)
+        state.stage((row[gram.pkeyindex], row) for row in records
+                    if row is not None and len(row) >= gram.rowlen
+                    and row[gram.pkeyindex] in fps)
+    # 4. triples to add and to remove, pkey by pkey
+    delta = DeltaWriter(source.name, settings.delta == "sparql")
+    if state.isnew:
+        gram.generate_schema(delta.adds)
+    shared = (RDFS.label, RDF.type)
+    # refs = { triple: change of the number of groups generating it }
+    refs = {}
+    def count_refs():
+        (adds, removes) = state.count({nt_line(triple): d for (triple, d) in refs.items()
+                                       if d != 0})
+        delta.write(delta.adds, adds)
+        delta.write(delta.removes, removes)
+        refs.clear()
+    for pkey in list(fps) + deleted:
+        old = TripleCollector()
+        for row in ([] if state.isnew else state.rows(pkey)):
+            gram.convert_row(row, old)
+        rows = state.staged(pkey) if pkey in fps else []
+        new = TripleCollector()
+        for row in rows:
+            gram.convert_row(row, new)
+        for triple in new:
+            if triple in old:
+                continue
+            if triple[1] in shared:
+                refs[triple] = refs.get(triple, 0) + 1
+            else:
+                delta.adds.add(triple)
+        for triple in old:
+            if triple in new:
+                continue
+            if triple[1] in shared:
+                refs[triple] = refs.get(triple, 0) - 1
+            else:
+                delta.removes.add(triple)
+        if pkey in fps:
+            state.put(pkey, fps[pkey], rows)
+        else:
+            state.delete(pkey)
+        if len(refs) >= RowState.BATCH:
+            count_refs()
+    count_refs()
+    delta.close()
+    myprint("Incremental: " + str(delta.adds.count) + " triples to add, "
+            + str(delta.removes.count) + " triples to remove")
+    # 5. state for the next run
+    state.commit({"grammar": gramfp, "version": RowState.VERSION})
+    state.close()
+    tim.stop()
+
+
+#================================================= Settings
+class Settings():
+    '''
+    Command line options, given to convert_source (and to the workers)
+    '''
+    def __init__(self):
+        self.stream = False
+        self.stdout = False
+        self.schema = False
+        self.jobs = 1
+        self.progress = True
+        self.split = 1
+        self.concat = False
+        self.loglevel = INFO
+        self.logthread = False
+        self.incremental = False
+        self.delta = "nt"
+        self.checkpoint = 0
+        self.resume = False
+        self.engine = ROWS
+        self.plan = False
+        self.profile = None
+        self.report = False
+        self.interval = 5
+        self.prometheus = None
+        self.compress = ""
+        self.memory = 0
+        self.maxerrors = None
+
+
+#================================================= convert_source
+def convert_source(source, settings, registry = None):
+    '''
+    Conversion of one source: grammar, schema, triples and dump.
+    Returns the duration in seconds.
+    '''
+    start = time.time()
+    if settings.incremental:
+        convert_source_incremental(source, settings, registry)
+        return time.time() - start
+    if settings.split > 1:
+        convert_source_chunks(source, settings, registry)
+        return time.time() - start
+    # checkpoints of the streaming conversion
+    checkpoint = None
+    resume = None
+    if settings.checkpoint > 0 or settings.resume:
+        checkpoint = Checkpoint(source, settings.checkpoint or 100000)
+        if settings.resume:
+            resume = checkpoint.load()
+
+    # determine name of the triplestore
+    backend = NTRIPLES if settings.stream else source.backend
+    if resume is not None:
+        store = NTriplesStore(resume["output"], False,
+                              (resume["outputsize"], resume["triples"]))
+    else:
+        store = make_store(source.name, backend, settings.stdout, settings.compress)
+
+    # Parsing the grammar file
+    profile_prefix(source.name + ".")
+    with profile_phase("grammar"):
+        gram = Grammar(source.semanticfile, source.domain, source.delim, registry)
+    memory_snapshot(source.name + " grammar")
+    if resume is not None:
+        gram.merge_missed(resume.get("missed", {}))
+    if settings.plan:
+        gram.plandump = source.name + "-plan.py"
+    report = None
+    if settings.report:
+        report = RunReport(source, settings.interval)
+        gram.counters = {}
+        gram.minter.track = True
+
+    # Generating the schema triples, once per grammar
+    if resume is not None:
+        pass # already in the partial output
+    elif settings.schema:
+        schemastore = make_store(source.name + "-schema", backend, False,
+                                 settings.compress)
+        with profile_phase("schema"):
+            gram.generate_schema(schemastore)
+            schemastore.dump()
+    else:
+        with profile_phase("schema"):
+            gram.generate_schema(store)
+
+    # Generating triples
+    quarantine = Quarantine(source.name + "-quarantine.csv", source.delim,
+                            settings.maxerrors, resume is not None,
+                            None if resume is None else resume.get("quarantine"))
+    try:
+        if settings.engine == COLUMNAR:
+            tim = Timer()
+            with profile_phase("rows"):
+                count = ColumnarEngine(gram).convert(source.file, store, quarantine)
+            tim.stop()
+            myprint("Information: " + str(count) + " csv row converted")
+        else:
+            count = gram.semantic_parser(source.file, store, settings.progress,
+                                         checkpoint, resume, report, quarantine)
+    finally:
+        # on ErrorBudgetExceeded, the checkpoint is kept for '--resume'
+        quarantine.close()
+
+    gram.report_misses(source.name + "-unmapped.csv")
+
+    # Dumping the triplestore
+    triples = store_size(store)
+    memory_snapshot(source.name + " before dump", triples)
+    with profile_phase("dump"):
+        store.dump()
+    # size of the dumped store: the distinct triples of a SQLite store
+    triples = store_size(store)
+    memory_snapshot(source.name + " after dump", triples)
+    if report is not None:
+        report.write(gram, max(count - 1, 0), triples)
+    if checkpoint is not None:
+        checkpoint.remove()
+    return time.time() - start
+
+
+def convert_source_worker(source, settings):
+    '''
+    Entry point of the worker processes (--jobs): no console, one log file
+    and one ontology registry per source, gathered by the parent process.
+    The log is written even if the conversion fails.
+    '''
+    logfile = source.name + ".log"
+    set_log(logfile, settings.loglevel)
+    set_console(None)
+    try:
+        if settings.profile is not None:
+            init_profile(settings.profile, source.name)
+        if settings.memory > 0:
+            init_memory(settings.memory)
+        registry = OntologyRegistry()
+        duration = convert_source(source, settings, registry)
+        profile_report()
+        memory_report()
+    finally:
+        close_log()
+    return (duration, registry, logfile)
+
+
+def convert_chunk_worker(gram, csvfile, header, chunk, partname, withschema, settings):
+    '''
+    Entry point of the worker processes (--split): conversion of one byte
+    range of the CSV file into a N-Triples part file, the bad rows into
+    [PART]-quarantine.csv
+    '''
+    (start, end, first) = chunk
+    set_log(partname + ".log", settings.loglevel)
+    set_console(None)
+    myprint("Part " + partname + ": rows from " + str(first))
+    if settings.profile is not None:
+        name = os.path.splitext(partname)[0]
+        init_profile(settings.profile, name)
+        profile_prefix(name + ".")
+    # a forked worker inherits the tracking of the parent process: started
+    # again for the worker (its own snapshots), stopped without '--memory'
+    stop_memory()
+    if settings.memory > 0:
+        init_memory(settings.memory)
+    store = NTriplesStore(partname)
+    if withschema:
+        gram.generate_schema(store)
+    quarantine = Quarantine(part_quarantine(partname), gram.delim, settings.maxerrors)
+    try:
+        with profile_phase("rows"):
+            count = gram.convert_chunk(csvfile, header, start, end, store, first,
+                                       quarantine)
+    finally:
+        quarantine.close()
+    memory_snapshot(partname + " before dump", store.count)
+    with profile_phase("dump"):
+        store.dump()
+    profile_report()
+    memory_report()
+    stop_memory()
+    close_log()
+    return (count, gram.missed_values())
+
+
+def part_quarantine(partname):
+    # [SOURCE].part-NNN.nt[.gz] -> [SOURCE].part-NNN-quarantine.csv
+    return partname.rpartition(".nt")[0] + "-quarantine.csv"
+
+
+def convert_source_chunks(source, settings, registry = None):
+    '''
+    A single CSV file is split into settings.split byte ranges, converted
+    in parallel into N-Triples part files [SOURCE].part-NNN.nt.
+    With settings.concat, the parts are concatenated in row order into
+    [SOURCE].nt, identical to the output of a serial '--stream' run.
+    The budget of bad rows applies to each part, then to their total.
+    '''
+    profile_prefix(source.name + ".")
+    with profile_phase("grammar"):
+        gram = Grammar(source.semanticfile, source.domain, source.delim, registry)
+    if settings.schema:
+        schemastore = NTriplesStore(source.name + "-schema.nt" + settings.compress)
+        gram.generate_schema(schemastore)
+        schemastore.dump()
+    header, chunks = split_csv(source.file, source.delim, settings.split)
+    myprint("Source " + source.name + " split in " + str(len(chunks)) + " chunks")
+    parts = [source.name + ".part-%03d.nt" % i + settings.compress
+             for i in range(len(chunks))]
+    jobs = settings.jobs if settings.jobs > 1 else settings.split
+    count = 0
+    quarantine = Quarantine(source.name + "-quarantine.csv", source.delim,
+                            settings.maxerrors)
+    tim = Timer()
+    try:
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            futures = [pool.submit(convert_chunk_worker, gram, source.file, header,
+                                   chunk, part, i == 0 and not settings.schema,
+                                   settings)
+                       for i, (chunk, part) in enumerate(zip(chunks, parts))]
+            for part, future in zip(parts, futures):
+                (partcount, missed) = future.result()
+                count += partcount
+                gram.merge_missed(missed)
+                quarantine.merge(part_quarantine(part))
+                append_log(part + ".log")
+                os.remove(part + ".log")
+    finally:
+        quarantine.close()
+    tim.stop()
+    quarantine.check()
+    myprint("Information: " + str(count) + " csv row converted")
+    gram.report_misses(source.name + "-unmapped.csv")
+    if settings.concat:
+        # compressed parts are gzip members or zstd frames: they concatenate too
+        output = source.name + ".nt" + settings.compress
+        with open(output, 'wb') as concat:
+            for part in parts:
+                with open(part, 'rb') as input:
+                    shutil.copyfileobj(input, concat, 1024 * 1024)
+                os.remove(part)
+        myprint("Parts concatenated into " + output)
+
+
+def convert_sources_parallel(sources, settings):
+    '''
+    Sources are converted in parallel by settings.jobs worker processes.
+    Logs and ontology registries are merged in the order of the sources,
+    the log of a failed source included. As in the serial run, a source
+    exceeding its budget of bad rows ('--max-errors') stops the run: the
+    sources not started are cancelled and the process exits with 1.
+    Returns the number of sources that failed.
+    '''
+    durations = []
+    aborted = None
+    with ProcessPoolExecutor(max_workers=settings.jobs) as pool:
+        futures = [pool.submit(convert_source_worker, source, settings)
+                   for source in sources]
+        for source, future in zip(sources, futures):
+            logfile = source.name + ".log"
+            error = None
+            try:
+                (duration, registry, logfile) = future.result()
+            except CancelledError:
+                durations.append((source.name, None))
+                continue
+            except Exception as e:
+                error = e
+                duration = None
+            myprint("-----------\nLog of source: " + source.name)
+            if os.path.isfile(logfile):
+                append_log(logfile)
+                os.remove(logfile)
+            if isinstance(error, ErrorBudgetExceeded):
+                myprint("Error: " + str(error) + ", conversion of source " + source.name
+                        + " aborted", ERROR)
+                aborted = source.name
+                pool.shutdown(wait=False, cancel_futures=True)
+            elif error is not None:
+                myprint("Error: conversion of source " + source.name
+                        + " failed: " + repr(error), ERROR)
+            else:
+                ONTOLOGY.merge(registry)
+            durations.append((source.name, duration))
+    myprint("-----------")
+    for (name, duration) in durations:
+        if duration is None:
+            myprint("Source " + name + ": failed")
+        else:
+            myprint("Source " + name + ": " + str(round(duration, 1)) + " seconds")
+    if aborted is not None:
+        myprint("Error: conversion aborted at source " + aborted + ". Exiting...", ERROR)
+        sys.exit(1)
+    return sum(1 for (name, duration) in durations if duration is None)
+
+
+#================================================= preview
+def preview(source, rows, grammarfile = None):
+    '''
+    Prints on stdout the N-Triples generated for the rows of the source
+    (header = row 0), read through the RowIndex of the CSV file: the
+    other rows are not read. grammarfile replaces the grammar of the
+    source, to check a change. Returns the number of rows converted.
+    '''
+    index = RowIndex(source.file, source.delim)
+    gram = Grammar(grammarfile or source.semanticfile, source.domain, source.delim,
+                   OntologyRegistry())
+    gram.bind_header(index.row(0))
+    quarantine = Quarantine(None, source.delim)
+    store = NTriplesStore(source.name, True)
+    count = 0
+    for n in rows:
+        if n < 1 or n >= len(index):
+            myprint("Warning: row " + str(n) + " not in " + source.file + " (rows 1 to "
+                    + str(len(index) - 1) + ")", WARNING)
+            continue
+        row = index.row(n)
+        store.write("# " + source.name + " row " + str(n) + "\n")
+        if row is None:
+            quarantine.add(n, "csv error: malformed record", [])
+        else:
+            gram.convert_row_checked(row, store, n, quarantine)
+        count += 1
+    store.output.flush()
+    index.close()
+    return count
+
+
+def preview_main(argv):
+    '''
+    'preview' command: csv2rdf preview -c CONFIG --rows N1,N2,... [--grammar G]
+    '''
+    try:
+        opts, args = getopt.getopt(argv, "c:h", ["conf=", "rows=", "grammar=",
+                                                 "source=", "help"])
+    except getopt.GetoptError:
+        usage()
+    options = None
+    rows = []
+    grammarfile = None
+    name = None
+    for o, a in opts:
+        if o in ("-h", "--help"):
+            usage()
+        if o in ("-c", "--conf"):
+            options = a
+        if o == "--rows":
+            rows = [to_int(n, range(1, 2**63)) for n in a.split(',')]
+        if o == "--grammar":
+            grammarfile = a
+        if o == "--source":
+            name = a
+    if options is None or len(rows) == 0:
+        usage()
+    # stdout is reserved to the triples
+    set_console(sys.stderr)
+    init_log()
+    opt = Options(options)
+    for source in opt.sources:
+        if name is not None and source.name != name:
+            continue
+        try:
+            preview(source, rows, grammarfile)
+        except GrammarError as e:
+            myprint("Error: " + str(e) + ", source " + source.name + " skipped", ERROR)
 
 
 #================================================= usage
 def usage():
     print("Utility to transform CSV files into RDF files")
-    print("Usage: \n $ csv2rdf -c [CONFIG] -i")
+    print("Usage: \n $ csv2rdf -c [CONFIG] [-s] [--stdout]")
     print("CONFIG must be an '.ini' file")
-    print("'-i' starts the step by step processing")
+    print("    optional 'backend' per source: memory (default), ntriples, sqlite")
+    print("'-s' or '--stream' writes N-Triples on the fly into [SOURCE].nt")
+    print("'--stdout' streams N-Triples to the standard output")
+    print("'--schema' writes the schema triples into [SOURCE]-schema.ttl (or .nt)")
+    print("'-j N' or '--jobs N' converts the sources in N parallel processes")
+    print("'--split N' converts each CSV file in N chunks in parallel (N-Triples parts)")
+    print("'--concat' concatenates the parts into [SOURCE].nt")
+    print("'--log-level LEVEL' is one of debug, info (default), warning, error")
+    print("'--log-thread' writes the log file in a background thread")
+    print("'--incremental' only converts the rows changed since the previous run")
+    print("    and writes [SOURCE]-delta-add.nt and [SOURCE]-delta-remove.nt")
+    print("'--delta sparql' writes the delta as a SPARQL Update script [SOURCE]-delta.ru")
+    print("'--checkpoint N' saves a checkpoint every N rows (N-Triples)")
+    print("'--resume' continues from the last checkpoint of each source")
+    print("'--engine columnar' converts by batches of rows with pandas (N-Triples)")
+    print("'--plan' writes the compiled execution plan into [SOURCE]-plan.py")
+    print("'--profile' profiles each phase with cProfile and writes profile/*.pstats")
+    print("    and the sampled stacks into profile/profile.collapsed (flamegraph)")
+    print("'--profile-light' only samples the stacks (low overhead)")
+    print("'--report' writes per column counters and the throughput into [SOURCE]-report.json")
+    print("    and counts the URI sanitisation collisions ('a-b' and 'a b' give the same URI)")
+    print("'--report-interval N' samples the throughput every N seconds (default 5)")
+    print("'--prometheus FILE' also writes the counters as a Prometheus textfile")
+    print("'--compress gzip|zstd' compresses the outputs on the fly ([SOURCE].nt.gz...)")
+    print("'--memory N' logs tracemalloc snapshots and RSS every N rows and around the dump")
+    print("'--max-errors N' aborts the run after N bad rows (default: no limit)")
+    print("    bad rows are written into [SOURCE]-quarantine.csv")
+    print("Preview: \n $ csv2rdf preview -c [CONFIG] --rows N1,N2,... [--grammar G] [--source S]")
+    print("    prints the triples of the rows N1, N2... of each source (header = row 0)")
+    print("    the rows are read through the index [FILE].rowidx, built at the first preview")
     sys.exit(0)
 
 
@@ -525,10 +2639,19 @@ def to_int(a, range):
 
 #================================================= main
 def main():
+    if len(sys.argv) > 1 and sys.argv[1] == "preview":
+        preview_main(sys.argv[2:])
+        return
     try:
         # Option 't' is a hidden option
-        opts, args = getopt.getopt(sys.argv[1:], "c:h",
-                                   ["conf=", "help"])
+        opts, args = getopt.getopt(sys.argv[1:], "c:hsj:",
+                                   ["conf=", "help", "stream", "stdout", "schema",
+                                    "jobs=", "split=", "concat",
+                                    "log-level=", "log-thread", "incremental",
+                                    "delta=", "checkpoint=", "resume", "engine=",
+                                    "plan", "profile", "profile-light",
+                                    "report", "report-interval=", "prometheus=",
+                                    "compress=", "memory=", "max-errors="])
     except getopt.GetoptError:
         # print help information and exit:
         usage()
@@ -536,42 +2659,153 @@ def main():
     if len(opts) == 0:
         usage()
     options = None
+    settings = Settings()
     for o, a in opts:
         if o in ("-h", "--help"):
             usage()
             sys.exit()
+        if o in ("-s", "--stream"):
+            settings.stream = True
+        if o == "--stdout":
+            settings.stream = True
+            settings.stdout = True
+            # stdout is reserved to the triples
+            set_console(sys.stderr)
+        if o == "--schema":
+            settings.schema = True
+        if o in ("-j", "--jobs"):
+            settings.jobs = to_int(a, range(1, 1025)) or 1
+        if o == "--split":
+            settings.split = to_int(a, range(1, 1025)) or 1
+        if o == "--concat":
+            settings.concat = True
+        if o == "--log-level":
+            settings.loglevel = LEVELS.get(a.lower(), INFO)
+        if o == "--log-thread":
+            settings.logthread = True
+        if o == "--incremental":
+            settings.incremental = True
+        if o == "--delta":
+            settings.delta = a.lower()
+        if o == "--checkpoint":
+            settings.checkpoint = to_int(a, range(1, 2**31))
+        if o == "--resume":
+            settings.resume = True
+        if o == "--memory":
+            settings.memory = to_int(a, range(1, 2**31)) or 100000
+        if o == "--max-errors":
+            settings.maxerrors = to_int(a, range(0, 2**31))
+        if o == "--compress":
+            settings.compress = COMPRESSIONS.get(a.lower(), GZIP)
+        if o == "--report":
+            settings.report = True
+        if o == "--report-interval":
+            settings.interval = to_int(a, range(1, 86401)) or 5
+        if o == "--prometheus":
+            settings.report = True
+            settings.prometheus = a
+        if o == "--profile":
+            settings.profile = FULL
+        if o == "--profile-light":
+            settings.profile = LIGHT
+        if o == "--plan":
+            settings.plan = True
+        if o == "--engine":
+            settings.engine = a.lower() if a.lower() in ENGINES else ROWS
         if o in ("-c", "--conf"):
             options = a
-            myprint("Configuration file: " + a)
 
     # default option file name if no options are provided
     if options == None:
         usage()
         sys.exit()
-    opt = Options(options)
+    init_log(level=settings.loglevel, threaded=settings.logthread)
+    if settings.profile is not None:
+        init_profile(settings.profile)
+    if settings.memory > 0:
+        init_memory(settings.memory)
+    myprint("Configuration file: " + options)
+    with profile_phase("options"):
+        opt = Options(options)
     opt.print()
 
+    if settings.stdout and (settings.jobs > 1 or settings.split > 1):
+        myprint("Warning: '--stdout' is not compatible with '--jobs' and '--split'",
+                WARNING)
+        settings.jobs = 1
+        settings.split = 1
+    if settings.split > 1 and not settings.stream:
+        myprint("Information: '--split' produces N-Triples")
+        settings.stream = True
+    if (settings.checkpoint > 0 or settings.resume) and settings.stdout:
+        myprint("Warning: checkpoints are not compatible with '--stdout'", WARNING)
+        settings.checkpoint = 0
+        settings.resume = False
+    if (settings.checkpoint > 0 or settings.resume) and not settings.stream:
+        myprint("Information: checkpoints require N-Triples output")
+        settings.stream = True
+    if settings.compress == ZSTD and zstandard is None:
+        myprint("Warning: zstd compression requires the zstandard package, using gzip",
+                WARNING)
+        settings.compress = GZIP
+    if settings.compress and (settings.checkpoint > 0 or settings.resume):
+        myprint("Warning: checkpoints require an uncompressed output, "
+                "'--compress' ignored", WARNING)
+        settings.compress = ""
+    if settings.report and (settings.incremental or settings.split > 1
+                            or settings.engine == COLUMNAR):
+        myprint("Warning: '--report' is only available for the row by row conversion",
+                WARNING)
+        settings.report = False
+        settings.prometheus = None
+    if settings.engine == COLUMNAR:
+        if not load_pandas():
+            myprint("Warning: the columnar engine requires pandas, using '"
+                    + ROWS + "'", WARNING)
+            settings.engine = ROWS
+        elif settings.incremental or settings.split > 1 or settings.checkpoint > 0 \
+             or settings.resume:
+            myprint("Warning: the columnar engine is not compatible with '--incremental', "
+                    "'--split' and checkpoints, using '" + ROWS + "'", WARNING)
+            settings.engine = ROWS
+        elif not settings.stream:
+            myprint("Information: the columnar engine produces N-Triples")
+            settings.stream = True
+
     # main loop
     globaltimer = Timer()
-    for source in opt.sources:
-        # determine name of the triplestore
-        output = source.name + ".ttl"
-        store = RDFStore(output)
-
-        # Parsing the grammar file
-        gram = Grammar(source.semanticfile, source.domain, source.delim)
-
-        # Generating triples
-        gram.semantic_parser(source.file, store)
-
-        # Dumping the triplestore
-        store.dump()
+    failed = 0
+    if settings.jobs > 1 and len(opt.sources) > 1 and settings.split == 1:
+        settings.progress = False
+        failed = convert_sources_parallel(opt.sources, settings)
+    else:
+        for source in opt.sources:
+            try:
+                convert_source(source, settings)
+            except GrammarError as e:
+                myprint("Error: " + str(e) + ", source " + source.name + " skipped",
+                        ERROR)
+                failed += 1
+            except ErrorBudgetExceeded as e:
+                myprint("Error: " + str(e) + ", conversion of source " + source.name
+                        + " aborted. Exiting...", ERROR)
+                sys.exit(1)
 
-    myprint("Dumping " + ONTO_REQ)
-    dump_define()
+    myprint("Dumping " + ONTO_REQ + " and " + ONTO_STUB)
+    profile_prefix("")
+    with profile_phase("define"):
+        dump_define()
+    if settings.prometheus is not None:
+        write_prometheus(settings.prometheus, opt.sources)
+    memory_report()
+    profile_report()
+    if failed != 0:
+        myprint("Error: " + str(failed) + " source(s) not converted", ERROR)
     myprint("Done")
     globaltimer.stop()
     myprint("Goodbye")
+    if failed != 0:
+        sys.exit(1)
     return
 
 
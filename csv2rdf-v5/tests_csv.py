@@ -0,0 +1,510 @@
+#============================================
+# File name:      tests_csv.py
+# Author:         Olivier Rey
+# Date:           September 2024
+# License:        GPL v3
+#============================================
+#!/usr/bin/env python3
+'''
+Tests of csv2rdf-v5, to be run from the csv2rdf-v5 folder:
+  $ python -m unittest tests_csv
+The fixture tests/fixture.csv has CRLF line endings, quoted new lines,
+a blank line and cells not in the map list: all the ways of converting
+it must give the same triples as a serial '--stream' run.
+'''
+
+import unittest, os, sys, subprocess, tempfile, importlib.util, json, gzip, sqlite3
+import rdflib
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+V5 = os.path.join(HERE, "csv2rdf-v5.py")
+FIXTURE = os.path.join(HERE, "tests", "fixture.csv")
+GRAMMAR = os.path.join(HERE, "tests", "fixture-grammar.ini")
+MALFORMED = os.path.join(HERE, "tests", "malformed.csv")
+ALTERATIONS = os.path.join(HERE, "tests", "alterations-grammar.ini")
+SOURCE = "FX"
+DOMAIN = "https://example.org/parts/"
+
+
+#============================================ helpers
+def load_v5():
+    '''
+    csv2rdf-v5.py cannot be imported by name (dash in the file name)
+    '''
+    sys.path.insert(0, HERE)
+    spec = importlib.util.spec_from_file_location("csv2rdf_v5", V5)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def write_conf(folder, csvfile=FIXTURE, grammar=GRAMMAR, backend=None):
+    conf = os.path.join(folder, "conf.ini")
+    with open(conf, 'w', encoding='utf-8') as f:
+        f.write("[" + SOURCE + "]\n")
+        f.write("file = " + csvfile + "\n")
+        f.write("domain = " + DOMAIN + "\n")
+        f.write("delimiter = ;\n")
+        f.write("semantics = " + grammar + "\n")
+        f.write("active = True\n")
+        if backend is not None:
+            f.write("backend = " + backend + "\n")
+    return conf
+
+def run_v5(folder, *options):
+    '''
+    Runs csv2rdf-v5.py in folder on the configuration of the folder
+    '''
+    return subprocess.run([sys.executable, V5, "-c", "conf.ini"] + list(options),
+                          cwd=folder, capture_output=True, text=True)
+
+def read(filename, mode='rb'):
+    with open(filename, mode) as f:
+        return f.read()
+
+
+#============================================ reference output
+class ConversionTestCase(unittest.TestCase):
+    '''
+    Each test gets a folder with the configuration of CSVFILE and
+    GRAMMARFILE and the output of a serial '--stream' run, self.reference
+    '''
+    CSVFILE = FIXTURE
+    GRAMMARFILE = GRAMMAR
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.folder = self.tmp.name
+        write_conf(self.folder, self.CSVFILE, self.GRAMMARFILE)
+        self.reference = self.convert("--stream")
+    def tearDown(self):
+        self.tmp.cleanup()
+    def convert(self, *options, output=SOURCE + ".nt"):
+        self.result = run_v5(self.folder, *options)
+        self.assertEqual(self.result.returncode, 0, self.result.stdout + self.result.stderr)
+        return read(os.path.join(self.folder, output))
+
+
+#============================================ TestStream
+class TestStream(ConversionTestCase):
+    def test_reference(self):
+        '''
+        Quoted CRLF new lines are read as LF, the blank line is skipped
+        '''
+        text = self.reference.decode('utf-8')
+        self.assertIn('"Nut\\nM6"', text)
+        self.assertIn('"Cable\\n3 wires\\n2 m"', text)
+        self.assertNotIn('\\r', text)
+        self.assertIn("<" + DOMAIN + "P_012>", text)
+
+    def test_split_concat(self):
+        '''
+        The parts of '--split N --concat' are concatenated in row order
+        '''
+        for n in (2, 3, 5):
+            with self.subTest(split=n):
+                self.assertEqual(self.convert("--split", str(n), "--concat"),
+                                 self.reference)
+
+    @unittest.skipIf(importlib.util.find_spec("pandas") is None, "pandas not installed")
+    def test_columnar(self):
+        self.assertEqual(self.convert("--engine", "columnar"), self.reference)
+
+    def test_compress(self):
+        '''
+        The compressed output, serial or concatenated parts, decompresses
+        into the '--stream' output
+        '''
+        for options in (("--stream",), ("--split", "3", "--concat")):
+            with self.subTest(options=options):
+                data = self.convert(*options, "--compress", "gzip",
+                                    output=SOURCE + ".nt.gz")
+                self.assertEqual(gzip.decompress(data), self.reference)
+
+
+#============================================ TestMalformed
+class TestMalformed(ConversionTestCase):
+    '''
+    tests/malformed.csv has rows with extra fields (ignored), short rows
+    (quarantined) and a blank line (skipped)
+    '''
+    CSVFILE = MALFORMED
+    def test_reference(self):
+        text = self.reference.decode('utf-8')
+        self.assertIn("<" + DOMAIN + "P_102>", text)
+        self.assertNotIn("<" + DOMAIN + "P_103>", text)
+        quarantine = read(os.path.join(self.folder, SOURCE + "-quarantine.csv"), 'r')
+        self.assertEqual([line.split(";")[0] for line in quarantine.splitlines()],
+                         ["row", "3", "6", "9"])
+
+    @unittest.skipIf(importlib.util.find_spec("pandas") is None, "pandas not installed")
+    def test_columnar(self):
+        quarantine = os.path.join(self.folder, SOURCE + "-quarantine.csv")
+        expected = read(quarantine)
+        self.assertEqual(self.convert("--engine", "columnar"), self.reference)
+        self.assertEqual(read(quarantine), expected)
+
+
+#============================================ TestQuarantine
+class TestQuarantine(unittest.TestCase):
+    def test_no_partial_row(self):
+        '''
+        A row whose conversion fails after some triples adds none of them
+        '''
+        v5 = load_v5()
+        v5.set_console(None)
+        v5.init_log(os.devnull)
+        self.addCleanup(v5.close_log)
+        gram = v5.Grammar(GRAMMAR, DOMAIN, ';', v5.OntologyRegistry())
+        gram.bind_header(["PART", "NAME", "SUPPLIER", "ASSEMBLY", "TAGS", "QTY"])
+        plan = gram.plan
+        def failing(row, add):
+            plan(row, add)
+            if row[0] == "P-2":
+                raise ValueError("bad cell")
+        gram.plan = failing
+        store = v5.TripleCollector()
+        quarantine = v5.Quarantine(None, ';')
+        for rownum, pkey in enumerate(("P-1", "P-2", "P-3"), 1):
+            gram.convert_row_checked([pkey, "Bolt", "acme", "A-1", "metal", "4"],
+                                     store, rownum, quarantine)
+        subjects = set(str(s) for (s, p, o) in store)
+        self.assertIn(DOMAIN + "P_1", subjects)
+        self.assertIn(DOMAIN + "P_3", subjects)
+        self.assertNotIn(DOMAIN + "P_2", subjects)
+        self.assertEqual(quarantine.count, 1)
+
+
+#============================================ TestMemo
+class TestMemo(unittest.TestCase):
+    def test_disabled_memo(self):
+        '''
+        A memo with a low hit rate is released, its counts are kept for
+        the report
+        '''
+        v5 = load_v5()
+        v5.set_console(None)
+        v5.init_log(os.devnull)
+        self.addCleanup(v5.close_log)
+        gram = v5.Grammar(GRAMMAR, DOMAIN, ';', v5.OntologyRegistry())
+        gram.bind_header(["PART", "NAME", "SUPPLIER", "ASSEMBLY", "TAGS", "QTY"])
+        colobj = gram.columns["ASSEMBLY"]
+        store = v5.TripleCollector()
+        lookups = colobj.MEMOPROBE + 1
+        for i in range(lookups):
+            gram.convert_row(["P-1", "Bolt", "acme", "A-" + str(i), "", "4"], store)
+        gram.check_memos()
+        self.assertTrue(colobj.memooff)
+        self.assertIsNone(colobj.memo)
+        info = colobj.memo_info()
+        self.assertEqual((info.hits, info.misses, info.currsize), (0, lookups, 0))
+        # the plan compiled again does not use the memo any more
+        gram.convert_row(["P-1", "Bolt", "acme", "A-0", "", "4"], store)
+        self.assertEqual(colobj.memo_info(), info)
+
+
+#============================================ TestMemoryFigures
+class TestMemoryFigures(unittest.TestCase):
+    def test_rss(self):
+        load_v5()
+        import tools
+        (current, peak) = tools.MemoryTracker.rss(None)
+        self.assertLessEqual(current, peak)
+
+    def test_without_resource(self):
+        '''
+        tools is imported without the resource module (Windows), the
+        memory figures being read elsewhere or 'n/a'
+        '''
+        code = ("import sys; sys.modules['resource'] = None; "
+                "sys.path.insert(0, sys.argv[1]); import tools, tracemalloc; "
+                "print(tools.MemoryTracker(0).figures()); tracemalloc.stop()")
+        result = subprocess.run([sys.executable, "-c", code, HERE],
+                                capture_output=True, text=True)
+        self.assertEqual(result.returncode, 0, result.stderr)
+        self.assertTrue(result.stdout.startswith("RSS "))
+
+
+#============================================ TestReport
+class TestReport(unittest.TestCase):
+    def test_sqlite(self):
+        '''
+        With the sqlite backend, the report and the Prometheus textfile
+        give the number of triples of the store
+        '''
+        with tempfile.TemporaryDirectory() as folder:
+            write_conf(folder, backend="sqlite")
+            result = run_v5(folder, "--report", "--prometheus", "metrics.prom")
+            self.assertEqual(result.returncode, 0, result.stdout + result.stderr)
+            db = sqlite3.connect(os.path.join(folder, SOURCE + ".sqlite"))
+            nb = db.execute("SELECT COUNT(*) FROM triples").fetchone()[0]
+            db.close()
+            self.assertGreater(nb, 0)
+            report = json.loads(read(os.path.join(folder, SOURCE + "-report.json")))
+            self.assertEqual(report["triples"], nb)
+            self.assertIn('csv2rdf_triples_total{source="' + SOURCE + '"} ' + str(nb),
+                          read(os.path.join(folder, "metrics.prom"), 'r'))
+
+
+#============================================ TestAlterations
+class TestAlterations(ConversionTestCase):
+    '''
+    tests/alterations-grammar.ini: map all/part/prefix, extract, prefix,
+    regex, regexmap, split, and the miss policies keep/drop/default
+    '''
+    GRAMMARFILE = ALTERATIONS
+    def test_reference(self):
+        text = self.reference.decode('utf-8')
+        for uri in ("ACME_Corporation", "unknown_supplier", "Bolt_family", "other",
+                    "Scr", "Gear_12_teethn_", "asm6", "Assembly_A", "Metal", "small"):
+            with self.subTest(uri=uri):
+                self.assertIn("<" + DOMAIN + uri + ">", text)
+        self.assertNotIn("<" + DOMAIN + "initech>", text)
+
+    def test_prefix_table(self):
+        '''
+        map(prefix;...) gives the value of the longest key prefixing the cell
+        '''
+        v5 = load_v5()
+        table = v5.PrefixTable({"a": "A", "ab": "AB", "abcd": "ABCD"})
+        for text, value in (("abc", "AB"), ("abcde", "ABCD"), ("a", "A"),
+                            ("b", None), ("", None)):
+            with self.subTest(text=text):
+                self.assertEqual(table.longest(text), value)
+
+    def test_rdflib(self):
+        '''
+        The URIs minted from multi-line cells are percent-encoded: the
+        '--stream' output is read by the N-Triples parser of rdflib
+        '''
+        graph = rdflib.Graph().parse(data=self.reference.decode('utf-8'), format='nt')
+        self.assertEqual(len(graph), len(set(self.reference.splitlines())))
+        self.assertIn(rdflib.URIRef(DOMAIN + "Nut%0AM6n_"), set(graph.subjects()))
+
+    @unittest.skipIf(importlib.util.find_spec("pandas") is None, "pandas not installed")
+    def test_columnar(self):
+        unmapped = os.path.join(self.folder, SOURCE + "-unmapped.csv")
+        expected = read(unmapped)
+        self.assertEqual(self.convert("--engine", "columnar"), self.reference)
+        self.assertEqual(read(unmapped), expected)
+
+    def test_split_concat(self):
+        self.assertEqual(self.convert("--split", "3", "--concat"), self.reference)
+
+
+#============================================ TestMapTable
+class TestMapTable(unittest.TestCase):
+    '''
+    External map tables, 'map(all;@suppliers.csv)', indexed into
+    [FILE].map.sqlite
+    '''
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.folder = self.tmp.name
+        self.table = os.path.join(self.folder, "suppliers.csv")
+        self.write_table("# key;value\nACME;ACME_Corporation\nglob;Globex\n")
+        self.v5 = load_v5()
+        self.v5.set_console(None)
+    def tearDown(self):
+        self.tmp.cleanup()
+    def write_table(self, text):
+        with open(self.table, 'w', encoding='utf-8') as f:
+            f.write(text)
+
+    def test_lookup(self):
+        '''
+        The keys are lowercased, the comments skipped, no temporary file
+        is left
+        '''
+        table = self.v5.MapTable(self.table, ';')
+        self.assertEqual(table.index, self.table + ".map.sqlite")
+        self.assertEqual(table["acme"], "ACME_Corporation")
+        self.assertEqual(table.get("glob"), "Globex")
+        self.assertNotIn("# key", table)
+        self.assertIsNone(table.get("initech"))
+        with self.assertRaises(KeyError):
+            table["initech"]
+        self.assertEqual(sorted(os.listdir(self.folder)),
+                         ["suppliers.csv", "suppliers.csv.map.sqlite"])
+        # the index is used as is
+        self.assertEqual(self.v5.MapTable(table.index, ';')["acme"], "ACME_Corporation")
+
+    def test_rebuild(self):
+        '''
+        The index is kept while the CSV file is unchanged, rebuilt when it
+        changes
+        '''
+        table = self.v5.MapTable(self.table, ';')
+        stamp = os.stat(table.index).st_mtime_ns
+        self.assertEqual(os.stat(self.v5.MapTable(self.table, ';').index).st_mtime_ns,
+                         stamp)
+        self.write_table("acme;Acme_Inc\ninitech;Initech\n")
+        table = self.v5.MapTable(self.table, ';')
+        self.assertEqual(table["acme"], "Acme_Inc")
+        self.assertEqual(table["initech"], "Initech")
+        self.assertIsNone(table.get("glob"))
+
+    def test_conversion(self):
+        '''
+        The alterations grammar with its *suppliers* list in a map table
+        gives the same triples, serial and in parts
+        '''
+        with open(ALTERATIONS, encoding='utf-8') as f:
+            grammar = f.read().replace(";*suppliers*)", ";@suppliers.csv)")
+        external = os.path.join(self.folder, "grammar.ini")
+        with open(external, 'w', encoding='utf-8') as f:
+            f.write(grammar)
+        write_conf(self.folder, FIXTURE, ALTERATIONS)
+        self.assertEqual(run_v5(self.folder, "--stream").returncode, 0)
+        reference = read(os.path.join(self.folder, SOURCE + ".nt"))
+        write_conf(self.folder, FIXTURE, external)
+        for options in (("--stream",), ("--split", "3", "--concat")):
+            with self.subTest(options=options):
+                result = run_v5(self.folder, *options)
+                self.assertEqual(result.returncode, 0, result.stdout + result.stderr)
+                self.assertEqual(read(os.path.join(self.folder, SOURCE + ".nt")), reference)
+
+
+#============================================ TestResume
+class InterruptedStore():
+    '''
+    Factory of NTriplesStore stopping the run after limit triples, the
+    output being flushed beyond the last checkpoint as by a killed process
+    '''
+    def __init__(self, v5, limit):
+        class Store(v5.NTriplesStore):
+            def add(store, triple):
+                if store.count == limit:
+                    store.output.close()
+                    raise KeyboardInterrupt
+                super().add(triple)
+        self.store = Store
+
+
+class TestResume(ConversionTestCase):
+    LIMIT = 80 # triples written before the interruption
+    def interrupt(self, every):
+        '''
+        Conversion stopped in the middle, in this process
+        '''
+        v5 = load_v5()
+        v5.set_console(None)
+        v5.init_log(os.devnull)
+        settings = v5.Settings()
+        settings.stream = True
+        settings.progress = False
+        settings.checkpoint = every
+        source = v5.Options(os.path.join(self.folder, "conf.ini")).sources[0]
+        v5.NTriplesStore = InterruptedStore(v5, self.LIMIT).store
+        cwd = os.getcwd()
+        os.chdir(self.folder)
+        try:
+            with self.assertRaises(KeyboardInterrupt):
+                v5.convert_source(source, settings, v5.OntologyRegistry())
+        finally:
+            os.chdir(cwd)
+            v5.close_log()
+        # the partial output goes beyond the last checkpoint
+        with open(os.path.join(self.folder, SOURCE + ".checkpoint"), encoding='utf-8') as f:
+            state = json.load(f)
+        self.assertGreater(os.path.getsize(os.path.join(self.folder, SOURCE + ".nt")),
+                           state["outputsize"])
+        return state
+
+    def test_resume(self):
+        '''
+        A run interrupted after a checkpoint and resumed gives the output,
+        the unmapped values and the quarantine of a run that was not
+        interrupted
+        '''
+        unmapped = os.path.join(self.folder, SOURCE + "-unmapped.csv")
+        misses = read(unmapped)
+        quarantine = os.path.join(self.folder, SOURCE + "-quarantine.csv")
+        badrows = read(quarantine) if os.path.isfile(quarantine) else None
+        for every in (2, 3):
+            with self.subTest(checkpoint=every):
+                state = self.interrupt(every)
+                self.assertEqual(self.convert("--resume"), self.reference)
+                self.assertEqual(read(unmapped), misses)
+                self.assertEqual(read(quarantine) if os.path.isfile(quarantine) else None,
+                                 badrows)
+                self.assertIn("Resuming at row " + str(state["rows"]), self.result.stdout)
+                self.assertFalse(os.path.isfile(os.path.join(self.folder,
+                                                             SOURCE + ".checkpoint")))
+
+
+class TestResumeMalformed(TestResume):
+    '''
+    Bad rows before and after the checkpoints: they are quarantined once
+    '''
+    CSVFILE = MALFORMED
+    LIMIT = 75 # in row 8, the short row 6 being after the checkpoints
+    def test_budget(self):
+        '''
+        The bad rows before the checkpoint count in the budget of the
+        resumed run
+        '''
+        self.interrupt(6)
+        self.result = run_v5(self.folder, "--resume", "--max-errors", "2")
+        self.assertNotEqual(self.result.returncode, 0)
+        self.assertIn("3 rows quarantined", self.result.stdout)
+
+
+#============================================ TestIncremental
+def edit_fixture(filename):
+    '''
+    Copy of the fixture with changed, deleted and added pkey groups: the
+    cell values 'umbrella' (supplier) and 'A-6' (assembly) are no longer
+    used, 'newco' is a new one
+    '''
+    with open(FIXTURE, 'r', encoding='utf-8', newline='') as f:
+        text = f.read()
+    text = text.replace("P-007;Gear/12 teeth;umbrella", "P-007;Gear/12 teeth;acme")
+    text = text.replace('"Cable\r\n3 wires\r\n2 m"', '"Cable\r\n4 wires"')
+    text = text.replace("P-011;Hinge;acme;A-6;metal;2\r\n", "")
+    text = text.replace("P-012;Latch;glob;A-6;;5\r\n", "P-013;Nail;newco;A-1;metal;9\r\n")
+    with open(filename, 'w', encoding='utf-8', newline='') as f:
+        f.write(text)
+
+def lines(data):
+    return set(data.decode('utf-8').splitlines())
+
+
+class TestIncremental(ConversionTestCase):
+    def delta(self):
+        return (lines(read(os.path.join(self.folder, SOURCE + "-delta-add.nt"))),
+                lines(read(os.path.join(self.folder, SOURCE + "-delta-remove.nt"))))
+
+    def test_incremental(self):
+        '''
+        The deltas applied to the previous triples give the triples of a
+        full conversion, labels and types of unused cell values removed
+        '''
+        csvfile = os.path.join(self.folder, "edited.csv")
+        with open(FIXTURE, 'rb') as f, open(csvfile, 'wb') as g:
+            g.write(f.read())
+        write_conf(self.folder, csvfile)
+        self.convert("--incremental", output=SOURCE + "-delta-add.nt")
+        (adds, removes) = self.delta()
+        self.assertEqual(adds, lines(self.reference))
+        self.assertEqual(removes, set())
+        # unchanged CSV file: empty delta
+        self.convert("--incremental", output=SOURCE + "-delta-add.nt")
+        self.assertEqual(self.delta(), (set(), set()))
+        # edited CSV file
+        edit_fixture(csvfile)
+        self.convert("--incremental", output=SOURCE + "-delta-add.nt")
+        (adds, removes) = self.delta()
+        expected = lines(self.convert("--stream"))
+        self.assertEqual((lines(self.reference) - removes) | adds, expected)
+        self.assertFalse(any("umbrella" in line for line in expected))
+        self.assertTrue(any("umbrella" in line for line in removes))
+
+    def test_sparql(self):
+        self.convert("--incremental", "--delta", "sparql", output=SOURCE + "-delta.ru")
+        script = read(os.path.join(self.folder, SOURCE + "-delta.ru")).decode('utf-8')
+        self.assertTrue(script.startswith("DELETE DATA {\n} ;\nINSERT DATA {\n"))
+        self.assertTrue(script.endswith("}\n"))
+        self.assertEqual(set(script.splitlines()[3:-1]), lines(self.reference))
+
+
+if __name__ == '__main__':
+    unittest.main()
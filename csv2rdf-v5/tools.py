@@ -1,22 +1,187 @@
-import csv, time
+import csv, time, sys, os, atexit, threading, queue, cProfile, pstats, io, gzip
+import tracemalloc, struct, mmap
+from array import array
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, nullcontext
+
+#Optional import: zstd compression
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 LOG = "run.log"
-FIRST = True
+# Console stream: stdout by default, stderr when the triples go to stdout,
+# None for no console at all (worker processes)
+CONSOLE = sys.stdout
+
+#--- Log levels
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+LEVELS = {"debug": DEBUG, "info": INFO, "warning": WARNING, "error": ERROR}
+
+#============================================ set_console
+def set_console(stream):
+    '''
+    Redirect the console messages (myprint, Timer) to another stream
+    '''
+    global CONSOLE
+    CONSOLE = stream
+
+
+#============================================ Log
+class Log():
+    '''
+    The log file stays open during the run and is written by blocks of
+    BUFFER characters, or by a background thread if threaded is True.
+    Warnings and errors sharing the same key (by default the message
+    itself) are only logged MAXREPEAT times, the others are counted.
+    '''
+    BUFFER = 64 * 1024
+    MAXREPEAT = 10
+    FLUSH = object()
+    def __init__(self, filename, level=INFO, threaded=False, truncate=False):
+        self.filename = filename
+        self.level = level
+        # the file is truncated at creation or at the first message
+        self.file = None
+        if truncate:
+            self.file = open(self.filename, "w", encoding='utf-8')
+        self.lines = []
+        self.size = 0
+        # self.repeats = { key: number of messages }
+        self.repeats = {}
+        self.queue = None
+        if threaded:
+            self.queue = queue.Queue()
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+    #--- buffer management
+    def append(self, text):
+        self.lines.append(text)
+        self.size += len(text)
+        if self.size >= self.BUFFER:
+            self.write_lines()
+    def write_lines(self):
+        if len(self.lines) == 0:
+            return
+        if self.file is None:
+            self.file = open(self.filename, "w", encoding='utf-8')
+        self.file.write(''.join(self.lines))
+        self.file.flush()
+        self.lines = []
+        self.size = 0
+    #--- background writer
+    def run(self):
+        while True:
+            text = self.queue.get()
+            if text is None:
+                self.write_lines()
+                self.queue.task_done()
+                return
+            if text is self.FLUSH:
+                self.write_lines()
+            else:
+                self.append(text)
+            self.queue.task_done()
+    #--- interface
+    def accept(self, msg, level, key):
+        '''
+        False if the message is under the level or is a repeated warning
+        '''
+        if level < self.level:
+            return False
+        if level >= WARNING:
+            if key is None:
+                key = msg
+            nb = self.repeats.get(key, 0) + 1
+            self.repeats[key] = nb
+            if nb > self.MAXREPEAT:
+                return False
+        return True
+    def write(self, text):
+        if self.queue is not None:
+            self.queue.put(text)
+        else:
+            self.append(text)
+    def flush(self):
+        if self.queue is not None:
+            self.queue.put(self.FLUSH)
+            self.queue.join()
+        else:
+            self.write_lines()
+    def close(self):
+        for key, nb in self.repeats.items():
+            if nb > self.MAXREPEAT:
+                self.write("Information: " + str(nb - self.MAXREPEAT)
+                           + " more message(s) not logged for: " + str(key) + '\n')
+        if self.queue is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.queue = None
+        self.write_lines()
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        self.repeats = {}
+
+LOGGER = Log(LOG)
+
+
+#============================================ init_log
+def init_log(filename=LOG, level=INFO, threaded=False):
+    '''
+    (Re)create the log, at the beginning of the run or in a worker process.
+    The previous log is dropped without being written: in a forked worker
+    process it is a copy of the log of the parent process.
+    '''
+    global LOGGER
+    LOGGER = Log(filename, level, threaded, truncate=True)
+
+
+#============================================ set_log
+def set_log(filename, level=INFO):
+    '''
+    Use another log file, truncated at the first message
+    '''
+    init_log(filename, level)
+
+
+#============================================ flush_log / close_log
+def flush_log():
+    LOGGER.flush()
+
+def close_log():
+    LOGGER.close()
+
+atexit.register(close_log)
+
+
+#============================================ append_log
+def append_log(filename):
+    '''
+    Append the content of another log file to the current log
+    '''
+    with open(filename, "r", encoding='utf-8') as other:
+        content = other.read()
+    LOGGER.write(content)
+
 
 #============================================ myprint
-def myprint(str):
+def myprint(msg, level=INFO, key=None):
     '''
     print to console and into a log file
+    key: repeated warnings with the same key are logged MAXREPEAT times
     '''
-    global FIRST
-    if FIRST:
-        with open(LOG, "w",encoding='utf-8') as logfile:
-            logfile.write(str + '\n')
-        FIRST = False
-    else:
-        with open(LOG, "a",encoding='utf-8') as logfile:
-            logfile.write(str + '\n')
-    print(str)
+    msg = str(msg)
+    if not LOGGER.accept(msg, level, key):
+        return
+    LOGGER.write(msg + '\n')
+    if CONSOLE is not None:
+        print(msg, file=CONSOLE)
         
 
 #============================================ interrupt
@@ -31,11 +196,157 @@ def interrupt(obj):
         exit(0)
 
 
+#=========================================== CSVRecords
+class CSVRecords():
+    '''
+    csv.reader on a CSV file, or on the byte range [start, end) of a CSV
+    file. The file is read in binary mode to track the byte offsets: after
+    each row, self.offset is the offset of the end of the record (quoted
+    new lines included). Decoding is the one of open(encoding='utf-8',
+    errors='ignore').
+    '''
+    def __init__(self, file, delim, start=0, end=None):
+        self.file = file
+        self.start = start
+        self.end = end
+        self.offset = start
+        self.reader = csv.reader(self.lines(), delimiter=delim)
+    def lines(self):
+        with open(self.file, "rb") as f:
+            f.seek(self.start)
+            for line in f:
+                if self.end is not None and self.offset >= self.end:
+                    return
+                self.offset += len(line)
+                if line.endswith(b'\r\n'):
+                    line = line[:-2] + b'\n'
+                yield line.decode('utf-8', errors='ignore')
+    def __iter__(self):
+        return self.reader
+    def tolerant(self):
+        '''
+        Rows of the file, None for a malformed record (csv.Error kept in
+        self.error): the reader goes on with the next line
+        '''
+        rows = iter(self.reader)
+        while True:
+            try:
+                row = next(rows)
+            except StopIteration:
+                return
+            except csv.Error as e:
+                self.error = e
+                row = None
+            yield row
+
+
+#=========================================== split_csv
+def split_csv(file, delim, nbchunks):
+    '''
+    Split a CSV file into nbchunks byte ranges cut on record boundaries.
+    Returns the header and a list of (start, end, number of the first row),
+    the header being row 0.
+    '''
+    size = os.path.getsize(file)
+    records = CSVRecords(file, delim)
+    rows = records.tolerant()
+    header = next(rows, None) or []
+    chunks = []
+    start = records.offset
+    first = 1
+    count = 1
+    target = start + (size - start) // nbchunks
+    for row in rows:
+        count += 1
+        if records.offset >= target and len(chunks) < nbchunks - 1:
+            chunks.append((start, records.offset, first))
+            start = records.offset
+            first = count
+            target = start + (size - start) // (nbchunks - len(chunks))
+    chunks.append((start, records.offset, first))
+    return header, chunks
+
+
+#=========================================== RowIndex
+class RowIndex():
+    '''
+    Sidecar index [FILE].rowidx of a CSV file: the byte offset of each
+    record (header = row 0, quoted new lines respected) and of the end of
+    the last one, as little endian uint64 after a header (MAGIC, size and
+    date of the CSV file, number of rows). The index is built again when
+    the CSV file changes. It is read with mmap: a row costs one seek.
+    '''
+    MAGIC = b"CSVROWS1"
+    HEADER = struct.Struct("<8sQQQ")
+    BLOCK = 100000 # offsets written at a time
+    def __init__(self, file, delim):
+        self.file = file
+        self.delim = delim
+        self.filename = file + ".rowidx"
+        if not self.valid():
+            self.build()
+        with open(self.filename, 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.rows = self.HEADER.unpack_from(self.map)[3]
+    def stamp(self):
+        stat = os.stat(self.file)
+        return (stat.st_size, stat.st_mtime_ns)
+    def valid(self):
+        if not os.path.isfile(self.filename):
+            return False
+        with open(self.filename, 'rb') as f:
+            header = f.read(self.HEADER.size)
+        if len(header) != self.HEADER.size:
+            return False
+        (magic, size, mtime, rows) = self.HEADER.unpack(header)
+        return magic == self.MAGIC and (size, mtime) == self.stamp() \
+            and os.path.getsize(self.filename) == self.HEADER.size + 8 * (rows + 1)
+    def build(self):
+        myprint("Indexing the rows of " + self.file + " into " + self.filename)
+        tim = Timer()
+        stamp = self.stamp()
+        records = CSVRecords(self.file, self.delim)
+        rows = 0
+        temp = self.filename + ".tmp"
+        with open(temp, 'wb') as f:
+            f.write(self.HEADER.pack(self.MAGIC, 0, 0, 0))
+            block = array('Q', [0])
+            for row in records.tolerant():
+                block.append(records.offset)
+                rows += 1
+                if len(block) >= self.BLOCK:
+                    self.write(f, block)
+                    block = array('Q')
+            self.write(f, block)
+            f.seek(0)
+            f.write(self.HEADER.pack(self.MAGIC, stamp[0], stamp[1], rows))
+        os.replace(temp, self.filename)
+        tim.stop()
+        myprint(str(rows) + " rows indexed")
+    def write(self, f, block):
+        if sys.byteorder == 'big':
+            block.byteswap()
+        block.tofile(f)
+    def __len__(self):
+        return self.rows
+    def offset(self, n):
+        return struct.unpack_from("<Q", self.map, self.HEADER.size + 8 * n)[0]
+    def row(self, n):
+        '''
+        Fields of row n, None if the record is malformed (csv.Error)
+        '''
+        if n < 0 or n >= self.rows:
+            raise IndexError("row " + str(n) + " not in " + self.file)
+        records = CSVRecords(self.file, self.delim, self.offset(n), self.offset(n + 1))
+        return next(records.tolerant(), None)
+    def close(self):
+        self.map.close()
+
+
 #=========================================== count lines in csv file
 def countLinesInCSVFile(file):
-    newreader = csv.reader(open(file, "r", encoding='utf-8', errors='ignore'))
     nblines = 0
-    for i, row in enumerate(newreader):
+    for row in CSVRecords(file, ',').tolerant():
         nblines += 1
     return nblines
 
@@ -46,10 +357,328 @@ class Timer():
         self.start = time.time()
     def stop(self):
         self.stop = time.time()
+        if CONSOLE is None:
+            return
         print("\nTreatment duration: "
               + str((round(self.stop-self.start))//60)
               + " minutes and "
               + str((round(self.stop-self.start))%60)
-              + " seconds\n")
+              + " seconds"
+              + ("" if MEMORY is None else " - " + MEMORY.figures())
+              + "\n", file=CONSOLE)
         
 
+
+#============================================ Profiler
+PROFILE_DIR = "profile"
+FULL = "full"   # cProfile per phase and sampled stacks
+LIGHT = "light" # sampled stacks only, cheap enough for production runs
+
+class Profiler():
+    '''
+    Profiling of the phases of a run (options, grammar, count, rows, dump,
+    define...), the phases not overlapping each other.
+    - FULL: one cProfile per phase, saved as PROFILE_DIR/[phase].pstats
+    - both modes: a thread samples the stack of the main thread every
+      INTERVAL seconds, saved as collapsed stacks ('phase;frame;frame N')
+      in PROFILE_DIR/[name].collapsed for flamegraph.pl or speedscope
+    The top TOP functions of each phase are printed by report().
+    '''
+    INTERVAL = 0.01
+    TOP = 10
+    def __init__(self, mode=FULL, name="profile", folder=PROFILE_DIR):
+        self.mode = mode
+        self.name = name
+        self.folder = folder
+        self.prefix = ""
+        self.current = None
+        # self.phases = { phase: [duration, cProfile or None] } in order
+        self.phases = {}
+        # self.stacks = { collapsed stack: number of samples }
+        self.stacks = {}
+        self.target = threading.main_thread().ident
+        self.running = True
+        self.sampler = threading.Thread(target=self.sample, daemon=True)
+        self.sampler.start()
+    #--- sampler thread
+    def sample(self):
+        while self.running:
+            time.sleep(self.INTERVAL)
+            phase = self.current
+            if phase is None:
+                continue
+            frame = sys._current_frames().get(self.target)
+            frames = []
+            while frame is not None:
+                code = frame.f_code
+                frames.append(os.path.basename(code.co_filename) + ":" + code.co_name)
+                frame = frame.f_back
+            stack = phase + ";" + ";".join(reversed(frames))
+            self.stacks[stack] = self.stacks.get(stack, 0) + 1
+    #--- phases
+    @contextmanager
+    def phase(self, name):
+        name = self.prefix + name
+        profile = cProfile.Profile() if self.mode == FULL else None
+        self.current = name
+        start = time.time()
+        if profile is not None:
+            profile.enable()
+        try:
+            yield
+        finally:
+            if profile is not None:
+                profile.disable()
+            self.current = None
+            if name in self.phases:
+                self.phases[name][0] += time.time() - start
+                if profile is not None:
+                    self.phases[name][1].add(profile)
+            else:
+                stats = pstats.Stats(profile) if profile is not None else None
+                self.phases[name] = [time.time() - start, stats]
+    #--- results
+    def top(self, phase):
+        '''
+        Returns [(function, seconds)] of the TOP functions of the phase
+        by own time (cProfile) or by samples of the innermost frame
+        '''
+        stats = self.phases[phase][1]
+        if stats is not None:
+            entries = sorted(stats.stats.items(), key=lambda x: x[1][2], reverse=True)
+            return [(os.path.basename(f) + ":" + str(l) + ":" + n, tt)
+                    for ((f, l, n), (cc, nc, tt, ct, callers)) in entries[:self.TOP]]
+        selftime = {}
+        for stack, nb in self.stacks.items():
+            if stack.startswith(phase + ";"):
+                leaf = stack.rsplit(";", 1)[1]
+                selftime[leaf] = selftime.get(leaf, 0) + nb * self.INTERVAL
+        return sorted(selftime.items(), key=lambda x: x[1], reverse=True)[:self.TOP]
+    def report(self):
+        self.running = False
+        self.sampler.join()
+        os.makedirs(self.folder, exist_ok=True)
+        for phase, (duration, stats) in self.phases.items():
+            if stats is not None:
+                stats.dump_stats(os.path.join(self.folder, phase + ".pstats"))
+        collapsed = os.path.join(self.folder, self.name + ".collapsed")
+        with open(collapsed, "w", encoding='utf-8', newline='\n') as f:
+            for stack, nb in self.stacks.items():
+                f.write(stack + " " + str(nb) + "\n")
+        for phase, (duration, stats) in self.phases.items():
+            myprint("Profile of phase '" + phase + "': " + "%.3f" % duration + " s")
+            for function, seconds in self.top(phase):
+                if seconds < 0.001:
+                    break
+                myprint("  %8.3f s  %s" % (seconds, function))
+        myprint("Profile written into " + self.folder + os.sep)
+
+PROFILER = None
+
+
+#============================================ profiling helpers
+def init_profile(mode=FULL, name="profile"):
+    global PROFILER
+    PROFILER = Profiler(mode, name)
+
+def profile_prefix(prefix):
+    '''
+    Prefix of the next phase names, e.g. the source name
+    '''
+    if PROFILER is not None:
+        PROFILER.prefix = prefix
+
+def profile_phase(name):
+    '''
+    Context manager profiling a phase, doing nothing without profiler
+    '''
+    if PROFILER is None:
+        return nullcontext()
+    return PROFILER.phase(name)
+
+def profile_report():
+    if PROFILER is not None:
+        PROFILER.report()
+
+
+#============================================ compressed outputs
+GZIP = ".gz"
+ZSTD = ".zst"
+COMPRESSIONS = {"gzip": GZIP, "gz": GZIP, "zstd": ZSTD, "zst": ZSTD}
+
+class CompressedFile(io.RawIOBase):
+    '''
+    Binary output compressed by blocks of BLOCK bytes in a pool of threads
+    (zlib and zstd release the GIL). Each block is an independent gzip
+    member or zstd frame: concatenated members are a valid file, which
+    also makes the concatenation of compressed parts valid (--split).
+    The writer only waits when more than 2 blocks per thread are pending.
+    '''
+    BLOCK = 4 * 1024 * 1024
+    THREADS = 2
+    def __init__(self, filename, threads=THREADS, level=6):
+        super().__init__()
+        self.output = open(filename, "wb")
+        if filename.endswith(ZSTD):
+            self.compress = zstandard.ZstdCompressor(level=3).compress
+        else:
+            self.compress = lambda block: gzip.compress(block, level, mtime=0)
+        self.pool = ThreadPoolExecutor(max_workers=threads)
+        self.maxpending = 2 * threads
+        self.pending = deque()
+        self.buffer = []
+        self.size = 0
+    def writable(self):
+        return True
+    def write(self, data):
+        self.buffer.append(bytes(data))
+        self.size += len(data)
+        if self.size >= self.BLOCK:
+            self.submit()
+        return len(data)
+    def submit(self):
+        if self.size == 0:
+            return
+        block = b"".join(self.buffer)
+        self.buffer = []
+        self.size = 0
+        self.pending.append(self.pool.submit(self.compress, block))
+        while len(self.pending) > self.maxpending or \
+              (self.pending and self.pending[0].done()):
+            self.output.write(self.pending.popleft().result())
+    def flush(self):
+        if self.closed or self.output.closed:
+            return
+        self.submit()
+        while self.pending:
+            self.output.write(self.pending.popleft().result())
+        self.output.flush()
+    def close(self):
+        if self.closed:
+            return
+        self.flush()
+        self.pool.shutdown()
+        # RawIOBase.close calls flush: the output must still be open
+        super().close()
+        self.output.close()
+
+
+def is_compressed(filename):
+    return filename.endswith(GZIP) or filename.endswith(ZSTD)
+
+def open_output(filename, binary=False, buffering=1024 * 1024):
+    '''
+    Opens an output file for writing, compressed according to its
+    extension (.gz or .zst), in text (utf-8) or binary mode
+    '''
+    if not is_compressed(filename):
+        if binary:
+            return open(filename, "wb", buffering=buffering)
+        return open(filename, "w", encoding='utf-8', newline='\n', buffering=buffering)
+    output = io.BufferedWriter(CompressedFile(filename), buffering)
+    if binary:
+        return output
+    return io.TextIOWrapper(output, encoding='utf-8', newline='\n')
+
+
+#============================================ MemoryTracker
+class MemoryTracker():
+    '''
+    Opt-in memory instrumentation ('--memory N'): tracemalloc snapshots at
+    the grammar load, every N rows and before/after the dump, each one
+    logged with the traced and RSS figures, the bytes per stored triple
+    and the allocation sites that grew the most since the previous one.
+    tracemalloc slows the run down: not for production runs.
+    '''
+    TOP = 10
+    FRAMES = 1
+    def __init__(self, every):
+        self.every = every
+        self.previous = None
+        tracemalloc.start(self.FRAMES)
+    def rss(self):
+        '''
+        Returns (current RSS, peak RSS) in bytes, both read from the same
+        source so that the peak is never below the current RSS; None for
+        the figures not available (no /proc, no resource module on Windows)
+        '''
+        try:
+            with open("/proc/self/status") as status:
+                fields = dict(line.split(":", 1) for line in status if ":" in line)
+            return (int(fields["VmRSS"].split()[0]) * 1024,
+                    int(fields["VmHWM"].split()[0]) * 1024)
+        except (OSError, KeyError, ValueError):
+            pass
+        try:
+            import resource # Unix only
+        except ImportError:
+            return (None, None)
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # kilobytes, except on macOS
+        return (None, peak if sys.platform == "darwin" else peak * 1024)
+    def figures(self):
+        (current, peak) = self.rss()
+        (traced, tracedpeak) = tracemalloc.get_traced_memory()
+        return ("RSS " + (mb(current) if current is not None else "n/a")
+                + " (peak " + (mb(peak) if peak is not None else "n/a") + "), traced "
+                + mb(traced) + " (peak " + mb(tracedpeak) + ")")
+    def snapshot(self, label, triples=None):
+        snapshot = tracemalloc.take_snapshot().filter_traces(
+            [tracemalloc.Filter(False, tracemalloc.__file__)])
+        msg = "Memory [" + label + "]: " + self.figures()
+        if triples:
+            (traced, tracedpeak) = tracemalloc.get_traced_memory()
+            msg += ", " + str(traced // triples) + " bytes per triple"
+        myprint(msg)
+        if self.previous is None:
+            stats = snapshot.statistics('lineno')
+        else:
+            stats = snapshot.compare_to(self.previous, 'lineno')
+        for stat in stats[:self.TOP]:
+            size = getattr(stat, "size_diff", stat.size)
+            if size < 1024:
+                break
+            frame = stat.traceback[0]
+            myprint("  +%10s  %s:%d" % (mb(size), frame.filename, frame.lineno))
+        self.previous = snapshot
+    def report(self):
+        myprint("Memory: top allocation sites")
+        self.previous = None
+        snapshot = tracemalloc.take_snapshot().filter_traces(
+            [tracemalloc.Filter(False, tracemalloc.__file__)])
+        for stat in snapshot.statistics('lineno')[:self.TOP]:
+            frame = stat.traceback[0]
+            myprint("  %10s in %8d blocks  %s:%d" % (mb(stat.size), stat.count,
+                                                  frame.filename, frame.lineno))
+        myprint("Memory: " + self.figures())
+
+def mb(size):
+    return "%.1f MB" % (size / 1024 / 1024)
+
+MEMORY = None
+
+
+#============================================ memory helpers
+def init_memory(every):
+    global MEMORY
+    MEMORY = MemoryTracker(every)
+
+def stop_memory():
+    global MEMORY
+    MEMORY = None
+    if tracemalloc.is_tracing():
+        tracemalloc.stop()
+
+def memory_every():
+    '''
+    Number of rows between two snapshots, 0 without memory tracking
+    '''
+    return 0 if MEMORY is None else MEMORY.every
+
+def memory_snapshot(label, triples=None):
+    if MEMORY is not None:
+        MEMORY.snapshot(label, triples)
+
+def memory_report():
+    if MEMORY is not None:
+        MEMORY.report()